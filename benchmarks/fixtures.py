@@ -0,0 +1,61 @@
+# coding: utf-8
+"Synthetic backend payloads, shaped like the json the backend sends."
+import json
+import random
+
+def address(rng):
+    return "z1qq" + "".join(rng.choice("0123456789abcdefghjklmnpqrstuvwxyz") for _ in range(36))
+
+def votes_json(rng):
+    return {'yes': rng.randrange(60), 'no': rng.randrange(20), 'abstain': rng.randrange(10)}
+
+def phase_json(rng, pid, n, status):
+    return {'id': f"{pid}-phase-{n}", 'pid': pid, 'created': 1650000000 + n * 86400,
+            'name': f"Phase {n} of the project", 'description': "Deliverables of this phase. " * 8,
+            'url': f"https://forum.zenon.org/t/project/{n}", 'znn': rng.randrange(5000),
+            'qsr': rng.randrange(50000), 'status': status, 'votes': votes_json(rng)}
+
+def project_json(rng, i, n_phases=0, owners=None):
+    pid = f"{i:064x}"
+    owner = rng.choice(owners) if owners else address(rng)
+    status = 1 if n_phases else rng.choice([0, 1])
+    # all but the last phase are paid
+    phases = [phase_json(rng, pid, n + 1, 2 if n + 1 < n_phases else rng.choice([0, 1]))
+              for n in range(n_phases)]
+    return {'id': pid, 'created': 1640000000 + i * 3600, 'description': "A project description. " * 20,
+            'status': status, 'name': f"Project {i}", 'owner': owner,
+            'url': f"https://forum.zenon.org/t/project-{i}", 'qsr': rng.randrange(500000),
+            'znn': rng.randrange(50000), 'phases': phases, 'votes': votes_json(rng)}
+
+def projects_json(n, n_phases=0, seed=1):
+    "n projects by a few owners, keyed by id like the active-projects reply"
+    rng = random.Random(seed)
+    owners = [address(rng) for _ in range(max(1, n // 10))]
+    projects = [project_json(rng, i, n_phases, owners) for i in range(n)]
+    return {p['id']: p for p in projects}
+
+def pillar_stats_json(n, seed=1):
+    rng = random.Random(seed)
+    items, open_items = 120, 8
+    return [{'name': f"Pillar{i}", 'rate': rng.choice([0, rng.randint(1, items)]) / items,
+             'active_rate': rng.randint(0, open_items) / open_items, 'items': items, 'open_items': open_items}
+            for i in range(n)]
+
+def update_frames(seed=1):
+    "One multipart update per handled type, as published by the backend"
+    rng = random.Random(seed)
+    project = project_json(rng, 1, 3)
+    pid = project['id']
+    phase = project['phases'][-1]
+    updates = {'project:new': {'id': pid, 'data': project},
+               'project:votes-update': {'id': pid, 'data': votes_json(rng)},
+               'project:status-update': {'id': pid, 'old': 0, 'new': 1},
+               'phase:new': {'id': phase['id'], 'data': phase},
+               'phase:update': {'id': phase['id'], 'old': project['phases'][-2]['id'], 'data': phase},
+               'phase:votes-update': {'id': phase['id'], 'pid': pid, 'data': votes_json(rng)},
+               'phase:status-update': {'id': phase['id'], 'pid': pid, 'old': 0, 'new': 1},
+               'pillar-stats': pillar_stats_json(100, seed),
+               'pillar:vote': {'name': "Pillar1", 'id': pid},
+               'send': {'text': "Manual update"},
+               'profile': {'action': "stop"}}
+    return {k: [k.encode('utf-8'), json.dumps(v).encode('utf-8')] for k, v in updates.items()}
@@ -0,0 +1,119 @@
+# coding: utf-8
+"""Per call cost of decoding, rendering and state bookkeeping, on synthetic fixtures.
+
+Results are written as json. Compared against a saved baseline, a case that got slower by
+more than the threshold fails the run."""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from zaz_telegram_py.types import Project, PillarVotingStatus, status_string
+from zaz_telegram_py.conf import TelegramState
+from zaz_telegram_py.main import (handler_map, decode_update, typed_update, summary_project_string,
+                                  format_overview_message, project_needs_votes, HandleRatesMessage,
+                                  HandlerContext, OverviewMessage)
+from fixtures import projects_json, pillar_stats_json, update_frames
+
+here = os.path.dirname(os.path.abspath(__file__))
+default_baseline = os.path.join(here, "baseline.json")
+
+def projects(n, n_phases=3):
+    return {k: Project(**v) for k, v in projects_json(n, n_phases).items()}
+
+def state_with(directory, n):
+    "A state with message ids for n projects"
+    state = TelegramState(os.path.join(directory, f"state-{n}.json"))
+    state.dump = lambda: None
+    for i, k in enumerate(projects_json(n).keys()):
+        state.message_ids_projects()[k] = i + 1
+    return state
+
+def cases(directory):
+    "Yields (name, callable)"
+    for key, frames in update_frames().items():
+        ctor = handler_map[key][0]
+        yield f"decode {key}", lambda frames=frames, ctor=ctor: typed_update(ctor, decode_update(frames)[1])
+
+    sample = list(projects(50, 5).values())
+    yield "Project.__str__", lambda: [str(p) for p in sample]
+    yield "status_string", lambda: [status_string(p) for p in sample]
+    votable = [p for p in sample if p.status <= 1]
+    yield "summary_project_string", lambda: [summary_project_string(p) for p in votable]
+
+    for n in [10, 100, 1000]:
+        active = sorted([p for p in projects(n).values() if project_needs_votes(p)], key=lambda p: p.created)
+        ctx = HandlerContext(None, None, state_with(directory, 0))
+        OverviewMessage(ctx)._format_message(active)
+        yield f"format_overview_message {n}", lambda state=ctx.state: format_overview_message(state)
+        yield f"OverviewMessage._format_message {n}", \
+            lambda ctx=ctx, active=active: OverviewMessage(ctx)._format_message(active)
+
+    for n in [100, 1000, 10000]:
+        pillars = [PillarVotingStatus(**p) for p in pillar_stats_json(n)]
+        yield f"HandleRatesMessage._format_message {n}", \
+            lambda pillars=pillars: HandleRatesMessage(None)._format_message(list(pillars))
+
+    for n in [100, 1000, 3000]:
+        state = state_with(directory, n)
+        # a few new, a few removed
+        ids = list(state.message_ids_projects().keys())[5:] + [f"new-{i}" for i in range(5)]
+        yield f"TelegramState.projects_diff {n}", lambda state=state, ids=ids: state.projects_diff(ids)
+
+def measure(f, min_time):
+    "Returns the best time per call, in seconds"
+    timer = timeit.Timer(f)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+    return min(timer.repeat(repeat=5, number=number)) / number
+
+def compare(results, baseline, threshold):
+    "Returns the names of the cases slower than the baseline by more than threshold"
+    regressions = []
+    for name, t in results.items():
+        if name in baseline and baseline[name] * (1 + threshold) < t:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--output", default=os.path.join(here, "results.json"))
+    parser.add_argument("--baseline", default=default_baseline)
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown against the baseline")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per measurement")
+    parser.add_argument("-k", default="", help="only run cases containing this")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, f in cases(directory):
+            if args.k not in name:
+                continue
+            results[name] = measure(f, args.min_time)
+            change = f"{results[name] / baseline[name] - 1:+7.1%}" if name in baseline else ""
+            print(f"{name:<45} {results[name] * 1e6:12.2f}us {change}")
+
+    with open(args.baseline if args.save_baseline else args.output, "w") as f:
+        json.dump(results, f, indent=4)
+
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print(f"Slower than the baseline by more than {args.threshold:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,41 @@
+# coding: utf-8
+"Memory used per project, for the typed records and for the decoded json they are built from."
+import argparse
+import gc
+import json
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from zaz_telegram_py.types import Project
+from fixtures import projects_json
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return result, used
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--projects", type=int, default=300)
+    parser.add_argument("--phases", type=int, default=30)
+    args = parser.parse_args()
+
+    payload = json.dumps(projects_json(args.projects, args.phases))
+    raw, raw_bytes = measure(lambda: json.loads(payload))
+    typed, typed_bytes = measure(lambda: {k: Project(**v) for k, v in json.loads(payload).items()})
+
+    print(f"{args.projects} projects with {args.phases} phases each")
+    print(f"json dicts:    {raw_bytes // args.projects:>8} bytes/project")
+    print(f"typed records: {typed_bytes // args.projects:>8} bytes/project")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+# coding: utf-8
+"""Scheduling overhead per message operation: the dispatcher against one APScheduler job per
+operation, which is what the job queue did before (only if apscheduler is installed)."""
+import argparse
+import asyncio
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from zaz_telegram_py.dispatch import Dispatcher
+
+async def noop(*args):
+    pass
+
+async def measure_dispatcher(n):
+    dispatcher = Dispatcher(0, first_delay=0)
+    dispatcher.start(None)
+    await asyncio.sleep(0)
+    start = time.perf_counter()
+    for _ in range(n):
+        dispatcher.schedule(noop, 0, None)
+    while dispatcher.pending() or dispatcher.running:
+        await asyncio.sleep(0)
+    elapsed = time.perf_counter() - start
+    await dispatcher.stop()
+    return elapsed / n
+
+async def measure_apscheduler(n):
+    from apscheduler.schedulers.asyncio import AsyncIOScheduler
+    scheduler = AsyncIOScheduler(timezone="UTC")
+    scheduler.start()
+    done = asyncio.Event()
+    remaining = [n]
+    async def job():
+        remaining[0] -= 1
+        if not remaining[0]:
+            done.set()
+    start = time.perf_counter()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for _ in range(n):
+        scheduler.add_job(job, "date", run_date=now, misfire_grace_time=None)
+    await done.wait()
+    elapsed = time.perf_counter() - start
+    scheduler.shutdown(wait=False)
+    return elapsed / n
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", type=int, default=20000, help="operations")
+    args = parser.parse_args()
+
+    print(f"dispatcher:  {asyncio.run(measure_dispatcher(args.n)) * 1e6:8.1f}us per operation")
+    try:
+        print(f"apscheduler: {asyncio.run(measure_apscheduler(args.n)) * 1e6:8.1f}us per operation")
+    except ImportError:
+        print("apscheduler: not installed")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+# coding: utf-8
+"Round trip time of backend requests over tcp, ipc and inproc, against the backend stand-in."
+import argparse
+import os
+import sys
+import tempfile
+import time
+import zmq
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from zaz_telegram_py.channels import Req
+from zaz_telegram_py.standin import StandIn
+from fixtures import projects_json
+
+def transports(directory):
+    return {"tcp": ("tcp://127.0.0.1:25555", "tcp://127.0.0.1:25556"),
+            "ipc": (f"ipc://{directory}/requests", f"ipc://{directory}/subscriptions"),
+            "inproc": ("inproc://requests", "inproc://subscriptions")}
+
+def measure(requests, subscriptions, projects, query, n):
+    context = zmq.Context()
+    standin = StandIn(context, requests, subscriptions, projects)
+    standin.start()
+    req = Req(context, requests)
+    req.get(query) # connect
+    start = time.perf_counter()
+    for _ in range(n):
+        req.get(query)
+    elapsed = time.perf_counter() - start
+    standin.stop()
+    context.destroy(linger=0)
+    return elapsed / n
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", type=int, default=2000, help="requests per transport")
+    parser.add_argument("--projects", type=int, default=50)
+    args = parser.parse_args()
+
+    projects = projects_json(args.projects, 3)
+    with tempfile.TemporaryDirectory() as directory:
+        for name, (requests, subscriptions) in transports(directory).items():
+            small = measure(requests, subscriptions, projects, [b"updates-since", b"0"], args.n)
+            large = measure(requests, subscriptions, projects, "active-projects", args.n // 10)
+            print(f"{name:>6}: {small * 1e6:8.1f}us per small request, "
+                  f"{large * 1e6:8.1f}us for {args.projects} projects")
+
+if __name__ == "__main__":
+    main()
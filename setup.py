@@ -8,10 +8,14 @@ setup(name="zaz-telegram-py",
       author_email="zdumeril@gmail.com",
       license="MIT",
       packages=["zaz_telegram_py"],
+      python_requires=">=3.10",
       install_requires=[
-          'pyzmq'
+          'pyzmq',
+          'httpx[http2]'
       ],
       entry_points = {
-          'console_scripts': ['zaz-telegram-bot=zaz_telegram_py.main:main'],
+          'console_scripts': ['zaz-telegram-bot=zaz_telegram_py.main:main',
+                              'zaz-telegram-replay=zaz_telegram_py.recording:main',
+                              'zaz-backend-standin=zaz_telegram_py.standin:main'],
       },
       zip_safe=False)
@@ -0,0 +1,125 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+import telegram
+
+from zaz_telegram_py import bot
+
+
+class FakeBot:
+    "Numbers messages like telegram does; sends can time out after delivery or answer late."
+    def __init__(self, next_id=100):
+        self.next_id = next_id
+        self.messages = {}
+        self.time_out = [] # per upcoming send: None, "delivered" or "lost"
+        self.delay = {} # text -> seconds until the response arrives
+
+    async def send_message(self, chat_id, text):
+        outcome = self.time_out.pop(0) if self.time_out else None
+        if outcome == "lost":
+            raise telegram.error.TimedOut()
+        m_id = self.next_id
+        self.next_id += 1
+        self.messages[m_id] = text
+        await asyncio.sleep(self.delay.get(text, 0))
+        if outcome == "delivered":
+            raise telegram.error.TimedOut()
+        return SimpleNamespace(message_id=m_id)
+
+    async def edit_message_reply_markup(self, chat_id, message_id, reply_markup):
+        if message_id not in self.messages:
+            raise telegram.error.BadRequest("Message to edit not found")
+        raise telegram.error.BadRequest("Message is not modified: specified new message content "
+                                        "and reply markup are exactly the same")
+
+    def post_by_admin(self):
+        m_id = self.next_id
+        self.next_id += 1
+        self.messages[m_id] = "admin"
+        return m_id
+
+
+@pytest.fixture(autouse=True)
+def ledger(monkeypatch):
+    monkeypatch.setattr(bot, "ledger", bot.SendLedger())
+    monkeypatch.setattr(bot, "reschedule_job", lambda *args: True)
+    return bot.ledger
+
+
+def send(fake, text, key=None, ids=None):
+    callback = ids.append if ids is not None else None
+    return bot.initiate_send(fake, 1, bot.MessageSendContext(text, callback, key))
+
+
+def message_ids(ids):
+    return [m.message_id for m in ids]
+
+
+def test_timed_out_send_found_after_delivery(ledger):
+    fake = FakeBot()
+    asyncio.run(send(fake, "first"))
+    fake.time_out = ["delivered"]
+    ids = []
+    job = bot.MessageSendContext("a", ids.append, "a")
+    asyncio.run(bot.initiate_send(fake, 1, job))
+    asyncio.run(bot.initiate_send(fake, 1, job))
+    assert message_ids(ids) == [101]
+    assert list(fake.messages) == [100, 101]
+    assert ledger.sent_id("a") == 101
+
+
+def test_no_verification_before_the_first_send(ledger):
+    ledger.observe(50)
+    fake = FakeBot()
+    fake.time_out = ["delivered"]
+    asyncio.run(send(fake, "a", "a"))
+    assert ledger.candidates("a") == []
+
+
+def test_send_in_flight_is_not_taken_over(ledger):
+    "A times out undelivered; C is delivered as 102 but answers late while A is retried."
+    fake = FakeBot()
+    async def scenario():
+        await send(fake, "first")
+        await send(fake, "second")
+        fake.time_out = ["lost"]
+        a_ids, c_ids = [], []
+        a = bot.MessageSendContext("a", a_ids.append, "a")
+        await bot.initiate_send(fake, 1, a)
+        fake.delay["c"] = 0.2
+        c = asyncio.create_task(send(fake, "c", "c", c_ids))
+        await asyncio.sleep(0.05)
+        await bot.initiate_send(fake, 1, a)
+        await c
+        return a_ids, c_ids
+    a_ids, c_ids = asyncio.run(scenario())
+    assert message_ids(c_ids) == [102]
+    assert message_ids(a_ids) == [103]
+    assert fake.messages[103] == "a"
+
+
+def test_foreign_post_is_not_taken_over(ledger):
+    fake = FakeBot()
+    asyncio.run(send(fake, "first"))
+    fake.time_out = ["lost"]
+    ids = []
+    job = bot.MessageSendContext("a", ids.append, "a")
+    asyncio.run(bot.initiate_send(fake, 1, job))
+    ledger.claim_foreign(fake.post_by_admin())
+    asyncio.run(bot.initiate_send(fake, 1, job))
+    assert message_ids(ids) == [102]
+    assert fake.messages[102] == "a"
+
+
+def test_overlapping_time_outs_post_again(ledger):
+    fake = FakeBot()
+    asyncio.run(send(fake, "first"))
+    fake.time_out = ["delivered", "delivered"]
+    asyncio.run(send(fake, "keyless"))
+    ids = []
+    job = bot.MessageSendContext("a", ids.append, "a")
+    asyncio.run(bot.initiate_send(fake, 1, job))
+    assert ledger.candidates("a") == []
+    asyncio.run(bot.initiate_send(fake, 1, job))
+    assert message_ids(ids) == [103]
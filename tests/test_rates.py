@@ -0,0 +1,38 @@
+from zaz_telegram_py.rates import PillarRates
+from zaz_telegram_py.types import PillarVotingStatus
+
+
+def checkpointed(items, open_items, *rates):
+    pillar_rates = PillarRates()
+    pillar_rates.checkpoint([PillarVotingStatus(name, rate, active_rate, items, open_items)
+                             for name, rate, active_rate in rates])
+    return pillar_rates
+
+
+def test_checkpoint_takes_the_counts():
+    rates = checkpointed(12, 0, ("a", 0.5, 0.0), ("b", 0.25, 0.0))
+    assert rates.checkpointed
+    assert rates.items == 12
+    assert list(rates.voted) == [6, 3]
+
+
+def test_checkpoint_without_counts_is_not_used():
+    rates = PillarRates()
+    rates.checkpoint([PillarVotingStatus("a", 0.5, 0.0)])
+    assert not rates.checkpointed
+
+
+def test_vote_on_a_missed_item_counts_it():
+    rates = checkpointed(2, 0, ("a", 0.5, 0.0))
+    rates.vote("a", "x")
+    assert (rates.items, rates.open_items()) == (3, 1)
+
+
+def test_vote_after_close_is_ignored():
+    rates = checkpointed(2, 0, ("a", 0.5, 0.0), ("b", 0.0, 0.0))
+    rates.open_item("x")
+    rates.vote("a", "x")
+    rates.close_item("x")
+    rates.vote("b", "x")
+    assert (rates.items, rates.open_items()) == (3, 0)
+    assert [(p.rate, p.active_rate) for p in rates.pillar_list()] == [(2 / 3, 0.0), (0.0, 0.0)]
@@ -2,29 +2,36 @@ import logging
 import telegram
 from telegram.ext import filters, MessageHandler, ApplicationBuilder, CallbackContext, CommandHandler, TypeHandler, Defaults
 from telegram.constants import ParseMode
+from telegram.request import HTTPXRequest
+import httpx
 import asyncio
 import threading
-import datetime
 import time
+from collections import OrderedDict, deque
+from types import SimpleNamespace
+
+# local
+from .dispatch import Dispatcher
 
 chat_id = 0
 application = None
 job_timedelta_s = 2
+ledger_size = 512
+ledger_ttl_s = 6 * 3600
+ledger_verify_candidates = 5
+delete_batch_max = 100 # limit of deleteMessages
+delete_batch_supported = True
+pending_deletes = {} # chat id -> list of MessageDeleteContext waiting for the next batch
+pending_deletes_lock = threading.Lock()
+stop_hooks = [] # called when the bot stops, before the queued operations are drained
+stop_drain_s = 30
 
 # Working with a bot in a channel is a mess; it's constantly causing time outs.
-# The job_queue interface has a 'when' parameter fortunately, so all jobs go through
-# this naive scheduler
-def schedule_job(job_executor, chat_id, context, add_delay=0):
-    now = datetime.datetime.utcnow()
-    try:
-        delay = datetime.timedelta(seconds=job_timedelta_s + add_delay)
-        schedule_job.when = max(now, schedule_job.when) + delay
-    except AttributeError:
-        schedule_job.when = now + datetime.timedelta(seconds=1)
+# So all jobs go through this naive scheduler, which spaces them by job_timedelta_s
+dispatcher = Dispatcher(job_timedelta_s)
 
-    effective_delta = schedule_job.when - datetime.datetime.utcnow() 
-    logging.debug(f"Scheduling job {context} to execute in {effective_delta}")
-    application.job_queue.run_once(job_executor, schedule_job.when, chat_id=chat_id, context=context)
+def schedule_job(job_executor, chat_id, context, add_delay=0):
+    dispatcher.schedule(job_executor, chat_id, context, add_delay)
 
 # Add a job to the scheduler with an increased timeout. This will still be followed by other
 # scheduled messages that don't have that increased timeout, but maybe it's good enough.
@@ -32,8 +39,10 @@ def reschedule_job(job_executor, chat_id, context):
     if context.can_retry():
         logging.debug(f"Rescheduling job {context}; {context.exec_attempt + 1} attempt")
         schedule_job(job_executor, chat_id, context, add_delay=job_timedelta_s * context.exec_attempt)
+        return True
     else:
         logging.error(f"Job {context} failed to execute")
+        return False
 
 def is_correct_chat(effective_chat_id):
     global chat_id
@@ -48,42 +57,216 @@ class JobContext:
         return self.exec_attempt < 5
 
 class MessageSendContext(JobContext):
-    def __init__(self, text, callback=None):
+    def __init__(self, text, callback=None, key=None):
         JobContext.__init__(self)
         self.text = text
         self.callback = callback
+        self.key = key
 
     def __str__(self):
-        return f"Send-Context for {self.text}"
+        return f"Send-{self.key}-Context for {self.text}"
+
+# A timed out send may still have been delivered. Sends carrying an idempotency key are recorded
+# here, so a retry can look for the first copy instead of posting the message twice.
+class LedgerEntry:
+    def __init__(self):
+        self.message_id = 0
+        self.after = None # last message id known when the send timed out
+        self.bound = 0 # first message id sent after the time out; a delivered copy is below it
+        self.time = time.monotonic()
+
+class SendLedger:
+    """Remembers the message ids of keyed sends and which sends timed out.
+    A send that timed out may have been delivered anyway; its copy is an unclaimed message
+    between the last id known at the time out and the first id sent afterwards. Sends still
+    waiting for their response and posts of others also leave unclaimed ids, so whenever one
+    of them could be in the range, the send is posted again instead."""
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.keyless = deque() # timed out sends without a key, their copies can't be identified
+        self.unbounded = [] # timed out sends waiting for the next sent message id
+        self.claimed = deque(maxlen=ledger_size) # message ids that belong to a known send
+        self.first_sent = 0 # first message id sent since the start
+        self.last_message_id = 0
+        self.in_flight = 0 # sends started and not answered yet
+
+    def _expire(self):
+        now = time.monotonic()
+        while self.entries:
+            entry = next(iter(self.entries.values()))
+            if len(self.entries) <= ledger_size and now - entry.time < ledger_ttl_s:
+                break
+            self.entries.popitem(last=False)
+        while self.keyless and now - self.keyless[0].time >= ledger_ttl_s:
+            self.keyless.popleft()
+
+    def _entry(self, key):
+        self._expire()
+        if key not in self.entries:
+            self.entries[key] = LedgerEntry()
+        return self.entries[key]
+
+    def _range(self, entry):
+        "Message ids a delivered copy of a timed out send might have gotten, as (after, last]."
+        return entry.after, entry.bound - 1 if entry.bound else self.last_message_id + 1
+
+    def observe(self, message_id):
+        self.last_message_id = max(self.last_message_id, message_id)
+
+    def claim(self, message_id):
+        "Records a message sent now, with or without a key."
+        if not self.first_sent:
+            self.first_sent = message_id
+        for entry in self.unbounded:
+            entry.bound = message_id
+        self.unbounded.clear()
+        self.claimed.append(message_id)
+        self.observe(message_id)
+
+    def claim_foreign(self, message_id):
+        "Records a message posted by someone else, as received with the bot's updates."
+        self.claimed.append(message_id)
+        self.observe(message_id)
+
+    def sent_id(self, key):
+        entry = self.entries.get(key)
+        return entry.message_id if entry else 0
+
+    def is_uncertain(self, key):
+        entry = self.entries.get(key)
+        return entry is not None and not entry.message_id and entry.after is not None
+
+    def mark_sent(self, key, message_id):
+        self._entry(key).message_id = message_id
+        self.claim(message_id)
+
+    def mark_found(self, key, message_id):
+        "Records that the copy of a timed out send was found; it's no longer an orphan."
+        entry = self._entry(key)
+        entry.message_id = message_id
+        entry.after = None
+        self.claimed.append(message_id)
+
+    def mark_uncertain(self, key):
+        if key:
+            entry = self._entry(key)
+            if entry.after is not None:
+                return
+        else:
+            self._expire()
+            entry = LedgerEntry()
+            self.keyless.append(entry)
+        # ids from before the start don't tell which later messages are ours
+        entry.after = self.last_message_id if self.first_sent else 0
+        self.unbounded.append(entry)
+
+    def candidates(self, key):
+        """Message ids the first copy of an uncertain send might have gotten.
+        Empty unless the send is the only one that timed out with a possible copy in that range,
+        so that any unclaimed message found there can only be its copy."""
+        entry = self.entries[key]
+        after, last = self._range(entry)
+        if not after or last - after > ledger_size or self.in_flight:
+            return []
+        others = [e for e in self.entries.values() if e is not entry and e.after is not None]
+        for other in others + list(self.keyless):
+            other_after, other_last = self._range(other)
+            if other_after < last and after < other_last:
+                return [] # copies of two sends can't be told apart
+        ids = [i for i in range(after + 1, last + 1) if i not in self.claimed]
+        return ids[:ledger_verify_candidates]
+
+ledger = SendLedger()
+
+def observe_message_ids(ids):
+    "Makes message ids from before a restart known to the ledger."
+    for m_id in ids:
+        ledger.observe(m_id)
+
+async def find_delivered_copy(bot, chat_id, key):
+    """Returns the id of an earlier, possibly delivered copy of a send, or 0.
+    Candidates are probed by removing a reply markup, which none of the bot's messages have:
+    'not modified' means the message exists and the bot may edit it, without changing it. It
+    doesn't tell who posted it; posts of others are excluded only once their update arrived."""
+    for candidate in ledger.candidates(key):
+        try:
+            await bot.edit_message_reply_markup(chat_id=chat_id, message_id=candidate, reply_markup=None)
+            logging.warning(f"Message {candidate} had a reply markup, not a copy of {key}")
+        except telegram.error.BadRequest as bad:
+            if bad.message.startswith("Message is not modified"):
+                return candidate
+    return 0
 
 class MessageEditContext(JobContext):
-    def __init__(self, message_id, text):
+    def __init__(self, message_id, text, callback=None):
         JobContext.__init__(self)
         self.message_id = message_id
         self.text = text
+        self.callback = callback
+
+    def done(self, edited):
+        if self.callback:
+            self.callback(self.message_id, edited)
 
     def __str__(self):
         return f"Edit-{self.message_id}-Context for {self.text}"
 
 class MessageDeleteContext(JobContext):
-    def __init__(self, message_id):
+    def __init__(self, message_id, callback=None):
         JobContext.__init__(self)
         self.message_id = message_id
+        self.callback = callback
+
+    def done(self, deleted):
+        "deleted is True or False, or None if the delete went out in a batch"
+        if self.callback:
+            self.callback(self.message_id, deleted)
 
     def __str__(self):
         return f"Delete-{self.message_id}-Context"
 
-async def initiate_send(context: CallbackContext):
-    text = context.job.context.text
+class MessageDeleteBatchContext(JobContext):
+    def __init__(self):
+        JobContext.__init__(self)
+        self.deletes = []
+
+    def __str__(self):
+        return f"Delete-{[d.message_id for d in self.deletes]}-Context"
+
+async def initiate_send(bot, chat_id, job: MessageSendContext):
+    text = job.text
+    key = job.key
     try:
-        message = await context.bot.send_message(chat_id=context.job.chat_id, 
-                                                 text=text)
-        if context.job.context.callback:
-            context.job.context.callback(message)
-    except (telegram.error.TimedOut, telegram.error.RetryAfter) as e:
+        if key and ledger.sent_id(key):
+            logging.info(f"Dropping send of {key}, already posted as {ledger.sent_id(key)}")
+            return
+        if key and ledger.is_uncertain(key):
+            m_id = await find_delivered_copy(bot, chat_id, key)
+            if m_id:
+                logging.info(f"Found delivered copy {m_id} of {key}, not sending again")
+                ledger.mark_found(key, m_id)
+                if job.callback:
+                    job.callback(SimpleNamespace(message_id=m_id))
+                return
+        ledger.in_flight += 1
+        try:
+            message = await bot.send_message(chat_id=chat_id, text=text)
+        finally:
+            ledger.in_flight -= 1
+        if key:
+            ledger.mark_sent(key, message.message_id)
+        else:
+            ledger.claim(message.message_id)
+        if job.callback:
+            job.callback(message)
+    except telegram.error.TimedOut as e:
+        # may have been delivered regardless
         logging.error(f"ERROR sending {text[0:20]}...: {str(e)}")
-        reschedule_job(initiate_send, context.job.chat_id, context.job.context)
-        #application.job_queue.run_once(initiate_send, 10, chat_id=context.job.chat_id, context=MessageSendContext(text, cb))
+        ledger.mark_uncertain(key)
+        reschedule_job(initiate_send, chat_id, job)
+    except telegram.error.RetryAfter as e:
+        logging.error(f"ERROR sending {text[0:20]}...: {str(e)}")
+        reschedule_job(initiate_send, chat_id, job)
     except Exception as e:
         logging.error(str(e))
 
@@ -92,24 +275,28 @@ def send_message(msg: MessageSendContext, chat_id=None):
         chat_id = globals()['chat_id']
     schedule_job(initiate_send, chat_id, msg)
 
-async def initiate_edit(context: CallbackContext):
-    m_id = context.job.context.message_id
-    text = context.job.context.text
+async def initiate_edit(bot, chat_id, job: MessageEditContext):
+    m_id = job.message_id
+    text = job.text
     try:
-        await context.bot.editMessageText(chat_id=context.job.chat_id, 
-                                          message_id=m_id, parse_mode=ParseMode.HTML,
-                                          text=text)
+        await bot.editMessageText(chat_id=chat_id, 
+                                  message_id=m_id, parse_mode=ParseMode.HTML,
+                                  text=text)
+        job.done(True)
     except telegram.error.BadRequest as bad:
         if bad.message.startswith("Message is not modified"):
             logging.debug("Ignoring edit error for unmodified message")
+            job.done(True)
         else:
             logging.error(bad)
+            job.done(False)
     except (telegram.error.TimedOut, telegram.error.RetryAfter) as e:
         logging.error(f"ERROR editing {m_id}: {str(e)}")
-        reschedule_job(initiate_edit, context.job.chat_id, context.job.context)
-        # application.job_queue.run_once(initiate_edit, 10, chat_id=context.job.chat_id, context=MessageEditContext(m_id, text))
+        if not reschedule_job(initiate_edit, chat_id, job):
+            job.done(False)
     except Exception as e:
         logging.error(e)
+        job.done(False)
 
 
 
@@ -118,29 +305,160 @@ def edit_message(edit: MessageEditContext, chat_id=None):
         chat_id = globals()['chat_id']
     schedule_job(initiate_edit, chat_id, edit)
 
-async def initiate_delete(context: CallbackContext):
-    m_id = context.job.context.message_id
+async def delete_each(bot, chat_id, deletes):
+    "Deletes the messages one by one. Returns the deletes that should be retried."
+    retry = []
+    for d in deletes:
+        try:
+            await bot.delete_message(chat_id=chat_id, message_id=d.message_id)
+            d.done(True)
+        except (telegram.error.TimedOut, telegram.error.RetryAfter) as e:
+            logging.error(f"ERROR deleting {d.message_id}: {str(e)}")
+            retry.append(d)
+        except Exception as e:
+            logging.error(f"ERROR deleting {d.message_id}: {str(e)}")
+            d.done(False)
+    return retry
+
+# Deletes for a chat are collected until the scheduled batch job runs and then go out with
+# a single deleteMessages call, falling back to single deletes where that's not possible.
+# deleteMessages succeeds even if it skips messages it can't find or delete, so a batch
+# doesn't tell which messages were deleted.
+async def initiate_delete_batch(bot, chat_id, batch: MessageDeleteBatchContext):
+    global delete_batch_supported
+    if not batch.deletes:
+        with pending_deletes_lock:
+            pending = pending_deletes.get(chat_id, [])
+            batch.deletes = pending[:delete_batch_max]
+            pending_deletes[chat_id] = pending[delete_batch_max:]
+            if pending_deletes[chat_id]:
+                schedule_job(initiate_delete_batch, chat_id, MessageDeleteBatchContext())
+    if not batch.deletes:
+        return
+
+    retry = batch.deletes
     try:
-        await context.bot.delete_message(chat_id=context.job.chat_id, 
-                                         message_id=m_id)
+        if 1 < len(batch.deletes) and delete_batch_supported:
+            await bot.delete_messages(chat_id=chat_id, message_ids=[d.message_id for d in batch.deletes])
+            [d.done(None) for d in batch.deletes]
+            retry = []
+        else:
+            retry = await delete_each(bot, chat_id, batch.deletes)
+    except AttributeError:
+        logging.warning("deleteMessages is not available, deleting messages one by one")
+        delete_batch_supported = False
+        retry = await delete_each(bot, chat_id, batch.deletes)
+    except telegram.error.BadRequest as bad:
+        # the batch fails as a whole; single deletes tell which message can't be deleted
+        logging.error(f"ERROR deleting {batch}: {str(bad)}")
+        retry = await delete_each(bot, chat_id, batch.deletes)
     except (telegram.error.TimedOut, telegram.error.RetryAfter) as e:
-        logging.error(f"ERROR deleting {m_id}: {str(e)}")
-        reschedule_job(initiate_delete, chat_id, context.job.context)
-        # application.job_queue.run_once(initiate_delete, 10, chat_id=context.job.chat_id, context=MessageDeleteContext(m_id))
+        logging.error(f"ERROR deleting {batch}: {str(e)}")
     except Exception as e:
         logging.error(str(e))
+        [d.done(False) for d in batch.deletes]
+        retry = []
+
+    if retry:
+        batch.deletes = retry
+        if not reschedule_job(initiate_delete_batch, chat_id, batch):
+            [d.done(False) for d in retry]
 
 def delete_message(ctx: MessageDeleteContext, chat_id=None):
     if not chat_id:
         chat_id = globals()['chat_id']
-    schedule_job(initiate_delete, chat_id, ctx)
+    with pending_deletes_lock:
+        pending = pending_deletes.setdefault(chat_id, [])
+        pending.append(ctx)
+        if 1 < len(pending):
+            return # picked up by the already scheduled batch
+    schedule_job(initiate_delete_batch, chat_id, MessageDeleteBatchContext())
 
-def build_bot(token, group_chat_id):
+# Polling and the outgoing messages use separate connection pools, so a long poll never holds
+# the connection a send is waiting for. Counting the opened connections against the requests
+# shows how well the pools keep connections alive.
+class InstrumentedRequest(HTTPXRequest):
+    log_every = 100
+
+    def __init__(self, name, http):
+        self.name = name
+        self.requests = 0
+        self.connections = 0
+        # HTTPXRequest doesn't expose the keep-alive expiry
+        self.limits = httpx.Limits(max_connections=http['pool-size'],
+                                   max_keepalive_connections=http['pool-size'],
+                                   keepalive_expiry=http['keepalive'])
+        HTTPXRequest.__init__(self, connection_pool_size=http['pool-size'],
+                              connect_timeout=http['connect-timeout'], read_timeout=http['read-timeout'],
+                              write_timeout=http['write-timeout'], pool_timeout=http['pool-timeout'],
+                              http_version="2" if http['http2'] else "1.1")
+
+    def _build_client(self):
+        "Called for every client HTTPXRequest creates, including the one rebuilt by initialize()"
+        try:
+            kwargs = dict(self._client_kwargs, limits=self.limits)
+        except AttributeError as e:
+            logging.warning(f"Can't tune the {self.name} connection pool: {str(e)}")
+            client = HTTPXRequest._build_client(self)
+        else:
+            client = httpx.AsyncClient(**kwargs)
+        client.event_hooks['request'].append(self._on_request)
+        return client
+
+    async def _on_request(self, request):
+        self.requests += 1
+        request.extensions['trace'] = self._trace
+        if 0 == self.requests % InstrumentedRequest.log_every:
+            logging.info(f"{self}")
+
+    async def _trace(self, event, info):
+        if event == "connection.connect_tcp.complete":
+            self.connections += 1
+
+    def __str__(self):
+        reused = 1 - self.connections / self.requests if self.requests else 0
+        return f"{self.name} requests: {self.requests}, connections opened: {self.connections}, reused {reused:.0%}"
+
+def build_bot(token, group_chat_id, http):
     global chat_id
     global application
     chat_id = group_chat_id
     defaults = Defaults(parse_mode=ParseMode.HTML)
-    application = ApplicationBuilder().token(token).defaults(defaults).build()
+    polling = dict(http, **{'pool-size': http['polling-pool-size']})
+    application = ApplicationBuilder().token(token).defaults(defaults) \
+        .request(InstrumentedRequest("api", http)) \
+        .get_updates_request(InstrumentedRequest("polling", polling)) \
+        .post_init(start_dispatcher).post_stop(stop_dispatcher).build()
+    application.add_handler(TypeHandler(telegram.Update, observe_foreign_post))
+
+async def observe_foreign_post(update, context):
+    "The bot gets no updates for its own messages; any message in the chat is someone else's."
+    message = update.effective_message
+    if message and message.chat_id == chat_id:
+        ledger.claim_foreign(message.message_id)
+
+async def start_dispatcher(app):
+    dispatcher.start(app.bot)
+
+async def stop_dispatcher(app):
+    for hook in stop_hooks:
+        try:
+            hook()
+        except Exception as e:
+            logging.error(f"Stop hook failed: {str(e)}")
+    await dispatcher.stop(drain=stop_drain_s)
     
-def run_bot():
-    application.run_polling(write_timeout=10)
+def run_bot(stop_signals=True):
+    "Without stop_signals, the bot ignores SIGINT and SIGTERM and is stopped with stop_bot"
+    if stop_signals:
+        application.run_polling()
+    else:
+        application.run_polling(stop_signals=None)
+
+def stop_bot():
+    "Stops run_bot from another thread; the stop hooks and the drain run as on a signal."
+    loop = dispatcher.loop
+    if loop:
+        loop.call_soon_threadsafe(application.stop_running)
+    else:
+        logging.warning("Bot not running, can't stop it")
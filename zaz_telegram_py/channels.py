@@ -1,29 +1,126 @@
 import logging
 import zmq
 import json
+import time
+import hashlib
+from collections import deque, OrderedDict
 from threading import Thread
 
 # local
 from .types import Project
 
-def connect(sock, port):
-    sock.connect(f"tcp://127.0.0.1:{port}")
+# failed request endpoints are skipped for a growing amount of time
+backoff_base_s = 2
+backoff_max_s = 60
+# decoded replies kept for conditional queries
+reply_cache_size = 256
+# copies of an update from redundant publishers are expected within this many seconds
+dedupe_window_s = 2
+
+def endpoint(address):
+    "Returns a zmq endpoint for a port number, a 'host:port' string or a complete endpoint uri."
+    if isinstance(address, int):
+        return f"tcp://127.0.0.1:{address}"
+    if "://" in address:
+        return address
+    return f"tcp://{address}"
+
+def endpoints(addresses):
+    "Accepts a single address or a list of addresses; see endpoint."
+    if not isinstance(addresses, list):
+        addresses = [addresses]
+    return [endpoint(a) for a in addresses]
+
+def connect(sock, address):
+    sock.connect(endpoint(address))
+
+class Backend:
+    "Health and latency bookkeeping for a single request endpoint."
+    def __init__(self, address):
+        self.address = address
+        self.latency = 0.0
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def is_healthy(self, now):
+        return now >= self.retry_at
+
+    def succeeded(self, latency):
+        # exponentially weighted, so a single slow answer does not dominate
+        self.latency = latency if not self.latency else 0.8 * self.latency + 0.2 * latency
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def failed(self, now):
+        self.failures += 1
+        self.retry_at = now + min(backoff_base_s * 2 ** (self.failures - 1), backoff_max_s)
+
+    def __str__(self):
+        return f"{self.address} ({self.latency * 1000:.1f}ms, {self.failures} failures)"
 
 class Req:
-    def __init__(self, context, port):
-        logging.info("Setting up requester on port %d", port)
-        self.socket = context.socket(zmq.REQ)
-        self.socket.setsockopt(zmq.LINGER, 200)
-        self.socket.setsockopt(zmq.RCVTIMEO, 1000)
-        self.socket.setsockopt(zmq.SNDTIMEO, 100)
-        connect(self.socket, port)
+    "Requester for one or more backends. Fails over to the next backend if one does not answer."
+    strategies = ["latency", "round-robin"]
 
-    def get(self, query):
-        if isinstance(query, list):
-            self.socket.send_multipart(query)
+    def __init__(self, context, addresses, strategy="latency"):
+        if strategy not in Req.strategies:
+            logging.error(f"Unknown request strategy {strategy}, using latency")
+            strategy = "latency"
+        self.context = context
+        self.strategy = strategy
+        self.backends = [Backend(a) for a in endpoints(addresses)]
+        self.sockets = {}
+        self.next = 0
+        self.replies = OrderedDict() # query -> (version, decoded reply)
+        logging.info("Setting up requester for %s", ", ".join(b.address for b in self.backends))
+
+    def _socket(self, backend):
+        if backend.address not in self.sockets:
+            socket = self.context.socket(zmq.REQ)
+            socket.setsockopt(zmq.LINGER, 200)
+            socket.setsockopt(zmq.RCVTIMEO, 1000)
+            socket.setsockopt(zmq.SNDTIMEO, 100)
+            connect(socket, backend.address)
+            self.sockets[backend.address] = socket
+        return self.sockets[backend.address]
+
+    def _drop_socket(self, backend):
+        # a REQ socket that missed its reply can't send again, so it's replaced on next use
+        socket = self.sockets.pop(backend.address, None)
+        if socket:
+            socket.close()
+
+    def _candidates(self):
+        "Returns the backends in the order they should be tried."
+        now = time.monotonic()
+        if self.strategy == "round-robin":
+            ordered = self.backends[self.next:] + self.backends[:self.next]
+            self.next = (self.next + 1) % len(self.backends)
         else:
-            self.socket.send_string(query)
-        return json.loads(self.socket.recv_string())
+            ordered = sorted(self.backends, key=lambda b: b.latency)
+        healthy = [b for b in ordered if b.is_healthy(now)]
+        # if every backend is backing off, try them anyway, the most promising first
+        return healthy if healthy else sorted(ordered, key=lambda b: b.retry_at)
+
+    def get(self, query):
+        for backend in self._candidates():
+            socket = self._socket(backend)
+            start = time.monotonic()
+            try:
+                if isinstance(query, list):
+                    socket.send_multipart(query)
+                else:
+                    socket.send_string(query)
+                reply = socket.recv_string()
+            except zmq.error.Again:
+                self._drop_socket(backend)
+                backend.failed(time.monotonic())
+                logging.warning(f"Backend {backend} did not answer")
+                continue
+            backend.succeeded(time.monotonic() - start)
+            return json.loads(reply)
+        logging.error("No backend answered the request")
+        return {"error": "no backend available"}
 
     def _validate_response(self, json):
         if "error" in json:
@@ -37,13 +134,40 @@ class Req:
                 projects[p] = Project(**json[p])
         return projects
 
+    # A backend that versions its data replies {"version": v, "data": ...}. Sending the version of
+    # the last reply along with the query, it replies {"version": v, "not-modified": true} if nothing
+    # changed since, and the reply doesn't have to be transferred and decoded again. Versions must
+    # mean the same on all backends, e.g. a momentum height. Plain replies are not cached.
+    def _conditional_get(self, query, decode):
+        "Returns the decoded reply, and whether it changed since the last time."
+        key = tuple(query)
+        cached = self.replies.get(key)
+        versioned = query + [str(cached[0]).encode('utf-8')] if cached else query
+        reply = self.get(versioned)
+        if "version" not in reply:
+            self.replies.pop(key, None)
+            return decode(reply), True
+        if reply.get("not-modified") and cached:
+            self.replies.move_to_end(key)
+            return cached[1], False
+        result = decode(reply["data"])
+        self.replies[key] = (reply["version"], result)
+        self.replies.move_to_end(key)
+        if len(self.replies) > reply_cache_size:
+            self.replies.popitem(last=False)
+        return result, True
+
     def import_projects_by_ids(self, ids):
-        b_ids = [id.encode('utf-8') for id in ids]
-        result = self.get([b"projects", json.dumps(ids).encode('utf-8')])
-        return self._projects_from_json(result)
+        result, _ = self._conditional_get([b"projects", json.dumps(ids).encode('utf-8')], self._projects_from_json)
+        return result
 
     def import_projects(self):
-        return self._projects_from_json(self.get("active-projects"))
+        result, _ = self._conditional_get([b"active-projects"], self._projects_from_json)
+        return result
+
+    def import_projects_modified(self):
+        "Returns the active projects, and whether they changed since the last call"
+        return self._conditional_get([b"active-projects"], self._projects_from_json)
 
     def import_current_phase(self, projects):
         logging.info("Getting current phase for %s", projects[0].id)
@@ -54,26 +178,56 @@ class Req:
     def import_updates(self, since):
         self.get([b"updates-since", str(since).encode('utf-8')])
 
-        
+class Deduplicator:
+    """Drops copies of an update received from other publishers. Copies arrive within moments of
+    each other, so digests are only remembered for a short window; an identical update published
+    again later is delivered."""
+    def __init__(self, window=dedupe_window_s):
+        self.window = window
+        self.seen = {}
+        self.order = deque()
+
+    def _expire(self, now):
+        while self.order and self.order[0][0] <= now - self.window:
+            _, digest = self.order.popleft()
+            self.seen.pop(digest, None)
+
+    def is_new(self, frames):
+        now = time.monotonic()
+        self._expire(now)
+        digest = hashlib.blake2b(b"\0".join(frames), digest_size=16).digest()
+        if digest in self.seen:
+            return False
+        self.seen[digest] = now
+        self.order.append((now, digest))
+        return True
+
 class Sub(Thread):
-    def __init__(self, context, port, onmessage):
+    "Subscriber connected to one or more publishers. Reconnects are handled by zmq."
+    def __init__(self, context, addresses, onmessage):
         Thread.__init__(self)
-        self.port = port
+        self.addresses = endpoints(addresses)
         self.context = context
         self.onmessage = onmessage
         self.stopped = False
+        # every backend publishes the same updates
+        self.deduplicator = Deduplicator() if len(self.addresses) > 1 else None
 
     def run(self):
         socket = self.context.socket(zmq.SUB)
         socket.setsockopt(zmq.SUBSCRIBE, b"")
         socket.setsockopt(zmq.LINGER, 200)
         socket.setsockopt(zmq.RCVTIMEO, 1000)
-        connect(socket, self.port)
+        # detect dead publishers so the connection is reestablished when they come back
+        socket.setsockopt(zmq.HEARTBEAT_IVL, 5000)
+        socket.setsockopt(zmq.HEARTBEAT_TIMEOUT, 15000)
+        for address in self.addresses:
+            connect(socket, address)
 
         while not self.stopped:
             try:
                 data = socket.recv_multipart()
-                if data:
+                if data and (not self.deduplicator or self.deduplicator.is_new(data)):
                     logging.info(f"Received update {data}")
                     self.onmessage(data)
             except zmq.error.Again:
@@ -3,6 +3,10 @@ from appdirs import *
 import os
 import json
 import logging
+import time
+
+# local
+from .rates import PillarRates
 
 def appname():
     return "zaz"
@@ -29,6 +33,12 @@ def telegram_config_file():
 def telegram_log_file():
     return os.path.join(logdir(), "telegram.log")
 
+def telegram_delivery_log_file():
+    return os.path.join(logdir(), "telegram-delivery.log")
+
+def telegram_recording_file():
+    return os.path.join(datadir(), "updates.rec")
+
 def init_paths():
     for dir in [datadir(), configdir(), logdir()]:
         print("creating ", dir)
@@ -54,6 +64,66 @@ class TelegramConfig:
     def subscriber_port(self):
         return self.content["subscriptions"]
 
+    def request_endpoints(self):
+        "A port, a 'host:port' string, an endpoint uri or a list of them"
+        return self.request_port()
+
+    def subscriber_endpoints(self):
+        "A port, a 'host:port' string, an endpoint uri or a list of them"
+        return self.subscriber_port()
+
+    def standin_fixtures(self):
+        "Fixtures for an embedded backend stand-in, None to use the real backend"
+        try:
+            return self.content["standin"]
+        except KeyError:
+            return None
+
+    def delivery_endpoints(self):
+        "The ops and acknowledgement endpoints between the ingest and delivery processes; None for a single process"
+        if not self.content.get("split-processes", False):
+            return None
+        return (self.content.get("delivery-ops", f"ipc://{datadir()}/delivery-ops"),
+                self.content.get("delivery-acks", f"ipc://{datadir()}/delivery-acks"))
+
+    def request_strategy(self):
+        try:
+            return self.content["request-strategy"]
+        except KeyError:
+            return "latency"
+
+    def recording_file(self):
+        "Where to record the received updates to; None if recording is off"
+        try:
+            record = self.content["record"]
+        except KeyError:
+            return None
+        if record is True:
+            return telegram_recording_file()
+        return record if record else None
+
+    default_http = {'pool-size': 8, 'polling-pool-size': 1, 'keepalive': 30, 'http2': False,
+                    'connect-timeout': 5.0, 'read-timeout': 10.0, 'write-timeout': 10.0, 'pool-timeout': 5.0}
+
+    def http_settings(self):
+        "Settings for the bot api connections; see default_http for the keys"
+        try:
+            return dict(TelegramConfig.default_http, **self.content["http"])
+        except KeyError:
+            return dict(TelegramConfig.default_http)
+
+    default_digest = {'window': 300, 'group': "window", 'urgent': []}
+
+    def digest_settings(self):
+        "None if notifications are sent one by one; see default_digest for the keys"
+        try:
+            digest = self.content["digest"]
+        except KeyError:
+            return None
+        if not digest:
+            return None
+        return dict(TelegramConfig.default_digest, **(digest if isinstance(digest, dict) else {}))
+
     def log_to_stdout(self):
         try:
             return self.content["logstd"]
@@ -67,8 +137,11 @@ class TelegramConfig:
         except KeyError:
             return levels["info"]
 
+# ids of messages that could not be deleted, kept in the state for a manual cleanup
+undeleted_keep = 100
+
 class TelegramState:
-    default_content = {'message-ids': {'overview': 0, 'rates': 0, 'projects': {}}}
+    default_content = {'message-ids': {'overview': 0, 'rates': 0, 'projects': {}, 'undeleted': []}}
 
     def __init__(self, filename=None):
         # can't use default to prevent evaluation before __init__
@@ -81,6 +154,11 @@ class TelegramState:
             self.content = json.load(f)
 
         self.project_strings = {}
+        self.pillar_rates = PillarRates()
+        self.overview_renders = 0
+        self.overview_current = False # the overview message shows the last rendered text
+        # closed and completed projects are moved out of the state into an append-only archive
+        self.archive_filename = os.path.splitext(self.filename)[0] + "-archive.jsonl"
 
     def dump(self):
         with open(self.filename, "w") as f:
@@ -100,6 +178,11 @@ class TelegramState:
         except KeyError as ke:
             logging.warning(f"Tried to delete nonexisting key {project_id} from project_strings")
 
+    def retain_project_strings(self, project_ids):
+        "Drops the strings of all projects not in project_ids"
+        for k in [k for k in self.project_strings if k not in project_ids]:
+            self.del_project_string(k)
+
     def message_ids(self):
         return self.content['message-ids']
 
@@ -126,6 +209,24 @@ class TelegramState:
         except KeyError:
             return 0
 
+    def message_ids_undeleted(self):
+        "Ids of messages that could not be deleted"
+        return self.message_ids().setdefault('undeleted', [])
+
+    def message_delete_result(self, message_id, deleted):
+        "deleted is None for messages deleted in a batch, which doesn't report single messages"
+        undeleted = self.message_ids_undeleted()
+        if deleted is None:
+            logging.debug(f"Message {message_id} deleted in a batch, result unknown")
+        elif deleted and message_id in undeleted:
+            undeleted.remove(message_id)
+            self.dump()
+        elif not deleted and message_id not in undeleted:
+            logging.warning(f"Message {message_id} could not be deleted")
+            undeleted.append(message_id)
+            del undeleted[:-undeleted_keep]
+            self.dump()
+
     def projects_diff(self, project_ids):
         "Returns three lists of project ids: the first with new projects, the second with deleted projects, third with existing."
         new_projects = []
@@ -158,3 +259,11 @@ class TelegramState:
             logging.error(f"Attempt to delete message for nonexisting project-id {project_id}")
         return m_id
 
+    def archive_project(self, project_id, status=None):
+        "Removes a project that is not active anymore from the state, to the archive file. Returns its message id."
+        m_id = self.project_message_id_remove(project_id)
+        self.project_strings.pop(project_id, None)
+        with open(self.archive_filename, "a") as f:
+            f.write(json.dumps({'id': project_id, 'status': status, 'message-id': m_id,
+                                'archived': int(time.time())}) + "\n")
+        return m_id
@@ -0,0 +1,89 @@
+# coding: utf-8
+import hashlib
+import logging
+import threading
+
+# local
+from .templates import max_message_length, notification_template, render_fitting, visible_length
+
+class Digest:
+    """Collects notifications for a time window and sends them as one message per window,
+    or one per project, instead of one message each."""
+
+    def __init__(self, settings, send):
+        self.window = settings['window']
+        self.per_project = settings['group'] == "project"
+        self.urgent = set(settings['urgent'])
+        self.send = send
+        self.lock = threading.Lock()
+        self.timer = None
+        self.projects = {} # project id -> [name, {key: text}], in order of arrival
+
+    def is_urgent(self, update_type):
+        return update_type in self.urgent
+
+    def add(self, project_id, name, text, key):
+        with self.lock:
+            if project_id not in self.projects:
+                self.projects[project_id] = [name, {}]
+            texts = self.projects[project_id][1]
+            if text not in texts.values():
+                texts[key] = text
+            if not self.timer:
+                self.timer = threading.Timer(self.window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def _render(self, groups):
+        return "\n\n".join(notification_template.render(name=name, text="\n".join(texts)) for name, texts in groups)
+
+    def _messages(self, projects):
+        """Yields (text, keys) of the messages for the collected notifications. A project's texts
+        continue in the next message under its name again if they don't fit into one."""
+        groups, keys, length = [], [], 0
+        for name, texts in projects.values():
+            if self.per_project and groups:
+                yield self._render(groups), keys
+                groups, keys, length = [], [], 0
+            header = notification_template.render(name=name, text="")
+            header_length = visible_length(header)
+            group = None
+            for key, text in texts.items():
+                size = visible_length(text) + 1
+                if max_message_length < header_length + size:
+                    cut = render_fitting(notification_template, "text", max_message_length - 1, name=name, text=text)
+                    text = cut[len(header):]
+                    size = visible_length(text) + 1
+                needed = size if group else header_length + size + 2
+                if groups and max_message_length < length + needed:
+                    yield self._render(groups), keys
+                    groups, keys, length = [], [], 0
+                    group = None
+                    needed = header_length + size
+                if not group:
+                    group = (name, [])
+                    groups.append(group)
+                group[1].append(text)
+                keys.append(key)
+                length += needed
+        if groups:
+            yield self._render(groups), keys
+
+    def close(self):
+        "Sends what was collected right away, e.g. before shutting down."
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+            pending = bool(self.projects)
+        if pending:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            projects, self.projects = self.projects, {}
+            self.timer = None
+        n = sum(len(texts) for _, texts in projects.values())
+        logging.info(f"Sending digest of {n} notifications for {len(projects)} projects")
+        for text, keys in self._messages(projects):
+            key = "digest:" + hashlib.sha1("|".join(keys).encode('utf-8')).hexdigest()
+            self.send(text, key=key)
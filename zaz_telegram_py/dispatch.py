@@ -0,0 +1,107 @@
+# coding: utf-8
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+class Dispatcher:
+    """Runs the message operations from a single coroutine on the bot's event loop.
+
+    Operations are queued from any thread with a due time on the monotonic clock. Each one gets
+    the next free slot, spacing them by at least spacing seconds, plus an optional extra delay
+    for retries. The coroutine sleeps until the next operation is due and starts it as a task,
+    so a slow api call doesn't hold back the following ones."""
+
+    def __init__(self, spacing, first_delay=1):
+        self.spacing = spacing
+        self.first_delay = first_delay
+        self.lock = threading.Lock()
+        self.heap = [] # (due, sequence number, executor, chat id, job context)
+        self.sequence = itertools.count()
+        self.next_slot = None
+        self.loop = None
+        self.wakeup = None
+        self.task = None
+        self.running = set()
+        self.dispatched = 0
+
+    def schedule(self, executor, chat_id, context, add_delay=0):
+        with self.lock:
+            now = time.monotonic()
+            if self.next_slot is None:
+                self.next_slot = now + self.first_delay
+            else:
+                self.next_slot = max(now, self.next_slot) + self.spacing + add_delay
+            due = self.next_slot
+            heapq.heappush(self.heap, (due, next(self.sequence), executor, chat_id, context))
+            loop = self.loop
+            wakeup = self.wakeup
+        logging.debug(f"Scheduling job {context} to execute in {due - now:.1f}s")
+        if loop:
+            loop.call_soon_threadsafe(wakeup.set)
+
+    def pending(self):
+        with self.lock:
+            return len(self.heap)
+
+    async def _execute(self, executor, bot, chat_id, context):
+        try:
+            await executor(bot, chat_id, context)
+        except Exception as e:
+            logging.error(f"Job {context} failed: {str(e)}")
+
+    def start(self, bot):
+        "Starts run as a task on the running event loop; stop cancels it."
+        self.task = asyncio.get_running_loop().create_task(self.run(bot))
+
+    async def stop(self, drain=0):
+        """Cancels the dispatching and waits for the operations already started.
+        With drain, queued operations are dispatched for up to that many seconds before."""
+        deadline = time.monotonic() + drain
+        while self.task and (self.pending() or self.running) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if self.running:
+            await asyncio.gather(*self.running, return_exceptions=True)
+
+    async def run(self, bot):
+        "Dispatches the operations until cancelled. Operations queued before are picked up."
+        wakeup = asyncio.Event()
+        with self.lock:
+            # published together, schedule() uses both
+            self.wakeup = wakeup
+            self.loop = asyncio.get_running_loop()
+        try:
+            await self._dispatch(bot, wakeup)
+        finally:
+            with self.lock:
+                self.loop = None
+                self.wakeup = None
+
+    async def _dispatch(self, bot, wakeup):
+        loop = asyncio.get_running_loop()
+        while True:
+            wakeup.clear()
+            with self.lock:
+                due = self.heap[0][0] if self.heap else None
+            if due is None:
+                await wakeup.wait()
+                continue
+            delay = due - time.monotonic()
+            if 0 < delay:
+                try:
+                    await asyncio.wait_for(wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            with self.lock:
+                _, _, executor, chat_id, context = heapq.heappop(self.heap)
+            self.dispatched += 1
+            task = loop.create_task(self._execute(executor, bot, chat_id, context))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
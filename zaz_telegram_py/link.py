@@ -0,0 +1,189 @@
+# coding: utf-8
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import zmq
+from types import SimpleNamespace
+
+# local
+from . import profiling
+from .bot import (send_message, edit_message, delete_message, observe_message_ids, stop_bot,
+                  MessageSendContext, MessageEditContext, MessageDeleteContext)
+
+# In the two process mode, the ingest process handles the updates and renders the messages, the
+# delivery process owns the bot and sends them. Operations go from ingest to delivery over one
+# PUSH/PULL pair, the ids of the delivered messages come back over another. The callbacks that
+# store message ids stay in the ingest process, which owns the state.
+
+# operations are held back until the delivery process is up, for at most this long
+ready_timeout_s = 60
+# callbacks of operations that are never acknowledged, e.g. sends that failed for good, are
+# dropped after this many seconds
+callback_ttl_s = 3600
+
+class DeliveryLink:
+    "Ingest side: forwards the outgoing operations and calls their callbacks on acknowledgement."
+    def __init__(self, context, ops_address, acks_address):
+        self.ops = context.socket(zmq.PUSH)
+        self.ops.setsockopt(zmq.LINGER, 1000)
+        self.ops.setsockopt(zmq.SNDTIMEO, 5000)
+        self.ops.bind(ops_address)
+        self.ops_lock = threading.Lock() # handlers, digest and startup threads all send
+        self.acks = context.socket(zmq.PULL)
+        self.acks.setsockopt(zmq.RCVTIMEO, 1000)
+        self.acks.bind(acks_address)
+        self.ids = itertools.count(1)
+        self.callbacks = {} # operation id -> (callback, time), in order of the ids
+        self.ready = threading.Event()
+        self.ready_by = time.monotonic() + ready_timeout_s
+        self.observed = None
+        self.stopped = False
+        self.receiver = threading.Thread(target=self._receive_acks, daemon=True)
+        self.receiver.start()
+        logging.info(f"Delivering messages via {ops_address}, acknowledgements via {acks_address}")
+
+    def _expire_callbacks(self):
+        now = time.monotonic()
+        while self.callbacks:
+            op_id = next(iter(self.callbacks))
+            if now - self.callbacks[op_id][1] < callback_ttl_s:
+                break
+            logging.warning(f"Operation {op_id} was never acknowledged")
+            del self.callbacks[op_id]
+
+    def _push(self, op, callback=None):
+        if not self.ready.wait(max(0, self.ready_by - time.monotonic())):
+            logging.warning("Delivery process didn't report ready, sending anyway")
+        with self.ops_lock:
+            op['id'] = next(self.ids)
+            try:
+                self.ops.send_string(json.dumps(op))
+            except zmq.error.Again:
+                logging.error(f"Delivery process not reachable, dropping {op['op']} operation")
+                return
+            if callback:
+                self._expire_callbacks()
+                self.callbacks[op['id']] = (callback, time.monotonic())
+
+    def _on_ready(self):
+        "The delivery process is up; it learns the known message ids first."
+        with self.ops_lock:
+            self.ready.set()
+            message_ids = self.observed
+        logging.info("Delivery process ready")
+        if message_ids is not None:
+            self._push({'op': "observe", 'message-ids': message_ids})
+
+    def _receive_acks(self):
+        while not self.stopped:
+            try:
+                ack = json.loads(self.acks.recv_string())
+            except zmq.error.Again:
+                continue
+            if ack.get('ready'):
+                self._on_ready()
+                continue
+            with self.ops_lock:
+                callback, _ = self.callbacks.pop(ack['id'], (None, 0))
+            if not callback:
+                continue
+            try:
+                if 'deleted' in ack:
+                    callback(ack['message-id'], ack['deleted'])
+                elif 'edited' in ack:
+                    callback(ack['message-id'], ack['edited'])
+                else:
+                    callback(SimpleNamespace(message_id=ack['message-id']))
+            except Exception as e:
+                logging.error(f"Callback for acknowledged operation {ack['id']} failed: {str(e)}")
+
+    def send(self, text, callback=None, key=None):
+        self._push({'op': "send", 'text': text, 'key': key}, callback)
+
+    def edit(self, message_id, text, callback=None):
+        self._push({'op': "edit", 'message-id': message_id, 'text': text}, callback)
+
+    def delete(self, message_id, callback=None):
+        self._push({'op': "delete", 'message-id': message_id}, callback)
+
+    def observe(self, message_ids):
+        "Makes message ids known to the delivery process, as soon as it is ready."
+        with self.ops_lock:
+            self.observed = message_ids
+            ready = self.ready.is_set()
+        if ready:
+            self._push({'op': "observe", 'message-ids': message_ids})
+
+    def stop_delivery(self):
+        "Stops the delivery process once it has scheduled all operations pushed before."
+        self._push({'op': "stop"})
+
+    def profile(self, control):
+        "Starts or stops the profiler in the delivery process too."
+        self._push({'op': "profile", 'action': control.action, 'duration': control.duration,
+                    'interval': control.interval})
+
+    def stop(self):
+        self.stopped = True
+        self.receiver.join()
+
+class Delivery(threading.Thread):
+    "Delivery side: schedules the received operations with the bot and acknowledges them."
+    def __init__(self, context, ops_address, acks_address):
+        threading.Thread.__init__(self, daemon=True)
+        self.ops = context.socket(zmq.PULL)
+        self.ops.setsockopt(zmq.RCVTIMEO, 1000)
+        self.ops.connect(ops_address)
+        # acknowledgements are sent from the bot's event loop only
+        self.acks = context.socket(zmq.PUSH)
+        self.acks.setsockopt(zmq.LINGER, 1000)
+        self.acks.connect(acks_address)
+        self.parent = os.getppid()
+        self.stopped = False
+
+    def _ack(self, ack):
+        self.acks.send_string(json.dumps(ack))
+
+    def handle(self, op):
+        op_id = op['id']
+        if op['op'] == "send":
+            send_message(MessageSendContext(op['text'], lambda m: self._ack({'id': op_id, 'message-id': m.message_id}),
+                                            op['key']))
+        elif op['op'] == "edit":
+            edit_message(MessageEditContext(op['message-id'], op['text'],
+                         lambda m_id, edited: self._ack({'id': op_id, 'message-id': m_id, 'edited': edited})))
+        elif op['op'] == "delete":
+            delete_message(MessageDeleteContext(op['message-id'],
+                           lambda m_id, deleted: self._ack({'id': op_id, 'message-id': m_id, 'deleted': deleted})))
+        elif op['op'] == "observe":
+            observe_message_ids(op['message-ids'])
+        elif op['op'] == "stop":
+            logging.info("Stopping on request of the ingest process")
+            stop_bot()
+        elif op['op'] == "profile":
+            if op['action'] == "start":
+                profiling.start(op['duration'], op['interval'])
+            elif op['action'] == "stop":
+                profiling.stop()
+        else:
+            logging.error(f"Unknown operation {op['op']}")
+
+    def run(self):
+        # nothing else is acknowledged before the first operation
+        self._ack({'ready': True})
+        while not self.stopped:
+            try:
+                op = json.loads(self.ops.recv_string())
+            except zmq.error.Again:
+                if os.getppid() != self.parent:
+                    logging.error("Ingest process is gone, stopping")
+                    stop_bot()
+                    self.stopped = True
+                continue
+            self.handle(op)
+
+    def stop(self):
+        self.stopped = True
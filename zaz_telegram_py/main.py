@@ -8,16 +8,24 @@ import sys
 import zmq
 import json
 import threading
+import multiprocessing
 from dataclasses import dataclass
 import logging
 from logging.handlers import RotatingFileHandler
 from .channels import Req, Sub
+from .recording import Recorder
+from .digest import Digest
+from .standin import start_embedded
+from .link import DeliveryLink, Delivery
+from . import profiling
+from .templates import (render_fitting, join_fitting, notification_template, phase_template, rate_template,
+                        summary_phase_template, summary_accepted_template, summary_template)
 from .types import (ProjectNew, ProjectVotesUpdate, ProjectStatusUpdate,
                     PhaseNew, PhaseUpdate, PhaseVotesUpdate, PhaseStatusUpdate,
-                    PillarVotingStatus, ManualSend, funds)
-from .bot import (build_bot, run_bot, send_message, edit_message, delete_message, 
-                  MessageSendContext, MessageEditContext, MessageDeleteContext)
-from .conf import TelegramState, TelegramConfig, telegram_log_file, init_paths
+                    PillarVotingStatus, PillarVote, ManualSend, ProfileControl, funds)
+from .bot import (build_bot, run_bot, send_message, edit_message, delete_message, observe_message_ids,
+                  stop_hooks, stop_drain_s, MessageSendContext, MessageEditContext, MessageDeleteContext)
+from .conf import TelegramState, TelegramConfig, telegram_log_file, telegram_delivery_log_file, init_paths
 
 def log_uncaught_exception(exc_type, exc_value, exc_traceback):
     # don't log Ctrl-C
@@ -27,34 +35,55 @@ def log_uncaught_exception(exc_type, exc_value, exc_traceback):
 
     logging.critical("Uncaught exception", exc_info=(exc_type, exc_value, exc_traceback))
 
-def setup_logging(config):
+def setup_logging(config, filename=None):
     log_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     logging.basicConfig(format=log_format, level=config.log_level())
     if config.log_to_stdout():
         logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
     logging.getLogger().addHandler(
-            RotatingFileHandler(telegram_log_file(), maxBytes=50000, backupCount=5))
+            RotatingFileHandler(filename if filename else telegram_log_file(), maxBytes=50000, backupCount=5))
     sys.excepthook = log_uncaught_exception
 
 stop = False
+link = None # DeliveryLink to the delivery process, if the bot runs there
 
 # interfaces with the bot module
 
-def send_with_bot(text, callback=None):
-    send_message(MessageSendContext(text, callback))
+def send_with_bot(text, callback=None, key=None):
+    "key identifies the announcement, so it's posted only once even if a send is retried"
+    if link:
+        link.send(text, callback, key)
+    else:
+        send_message(MessageSendContext(text, callback, key))
 
-def edit_bot_message(message_id, text):
-    edit_message(MessageEditContext(message_id, text))
+def notify(ctx, update_type, project, text, key):
+    "Sends a notification about a project, or collects it for the digest"
+    digest = ctx.config.digest
+    if digest and not digest.is_urgent(update_type):
+        digest.add(project.id, project.name, text, key)
+    else:
+        send_with_bot(notification_template.render(name=project.name, text=text), key=key)
 
-def delete_bot_message(message_id):
-    delete_message(MessageDeleteContext(message_id))
+def edit_bot_message(message_id, text, callback=None):
+    "callback is called with the message id and whether the message shows text now"
+    if link:
+        link.edit(message_id, text, callback)
+    else:
+        edit_message(MessageEditContext(message_id, text, callback))
+
+def delete_bot_message(message_id, callback=None):
+    "callback is called with the message id and whether it was deleted, None if that's unknown"
+    if link:
+        link.delete(message_id, callback)
+    else:
+        delete_message(MessageDeleteContext(message_id, callback))
 
 # zmq backend subscriber
 
 class Subscriber():
-    def __init__(self, context, port, onmessage):
-        logging.info("Setting up subscriber on port %d", port)
-        self.subscriber = Sub(context, port, onmessage)
+    def __init__(self, context, addresses, onmessage):
+        logging.info("Setting up subscriber for %s", addresses)
+        self.subscriber = Sub(context, addresses, onmessage)
         
     def __enter__(self):
         self.subscriber.start()
@@ -77,21 +106,21 @@ def summary_project_string(p):
     "Parameter p must be a project with status <= 1"
     if p.status == 1 and len(p.phases):
         phase_string = summary_phase_string(p.phases[-1])
-        summary = f"<b>{p.name}</b> <i>Phase {len(p.phases)}</i>\n{p.phases[-1].votes}"
+        summary = summary_phase_template.render(name=p.name, n=len(p.phases), votes=str(p.phases[-1].votes))
         return summary + phase_string
     elif p.status == 1:
-        return f"<b>{p.name}</b>\n{p.votes} (<i>Accepted</i>)"
+        return summary_accepted_template.render(name=p.name, votes=str(p.votes))
     elif p.status == 0:
-        return f"<b>{p.name}</b>\n{p.votes}"
+        return summary_template.render(name=p.name, votes=str(p.votes))
     else: # should not happen
         logging.error(f"Unexpected project status {p.status}")
         return ""
 
 def format_overview_message(state):
     header = "<b>These projects need voting</b>\n\n"
-    strings = state.get_project_strings()
-    logging.info(f"Projectstrings: {strings}")
-    return header + "\n".join(strings)
+    strings = list(state.get_project_strings())
+    logging.info("Projectstrings: %s", strings)
+    return join_fitting(header, strings)
 
 def status_update_string(value):
     strings = {1: "accepted", 2: "paid", 3: "closed", 4: "completed"}
@@ -121,9 +150,15 @@ class OverviewMessage:
     def __init__(self, context):
         self.ctx = context
 
-    def _store_message_id(self, m):
+    def _store_message_id(self, m, render):
         logging.info("Storing overview message id %d", m.message_id)
         self.ctx.state.set_message_id_overview(m.message_id)
+        self._delivered(render, True)
+
+    def _delivered(self, render, delivered):
+        "Only the outcome of the latest render tells whether the message is current"
+        if render == self.ctx.state.overview_renders:
+            self.ctx.state.overview_current = delivered
 
     def _projects_that_need_action(self, projects):
         return sorted([p for p in projects.values() if project_needs_votes(p)], key=lambda p: p.created)
@@ -133,23 +168,31 @@ class OverviewMessage:
         self.ctx.state.set_project_string(project.id, text)
 
     def _format_message(self, active_projects):
+        self.ctx.state.retain_project_strings({p.id for p in active_projects})
         [self._make_and_store_project_text(p) for p in active_projects]
         return format_overview_message(self.ctx.state)
 
     def run(self):
         "Creates a new overview message if none is configured yet. Else, updates the existing."
-        active_projects = self.ctx.config.requester.import_projects()
-        if active_projects:
+        state = self.ctx.state
+        active_projects, modified = self.ctx.config.requester.import_projects_modified()
+        if not modified and state.message_id_overview() and state.overview_current:
+            logging.info("Active projects not modified, keeping the overview message")
+        elif active_projects:
             votable_projects = self._projects_that_need_action(active_projects)
             message_text = self._format_message(votable_projects)
-            existing_message_id = self.ctx.state.message_id_overview()
+            state.overview_renders += 1
+            state.overview_current = False
+            render = state.overview_renders
+            existing_message_id = state.message_id_overview()
             if 0 != existing_message_id:
                 logging.info("Updating overview message with id=%d", existing_message_id)
-                edit_bot_message(existing_message_id, message_text)
+                edit_bot_message(existing_message_id, message_text,
+                                 lambda m_id, edited: self._delivered(render, edited))
             else:
                 logging.info("Creating new overview message")
-                send_with_bot(message_text, lambda m: self._store_message_id(m))
-            return active_projects
+                send_with_bot(message_text, lambda m: self._store_message_id(m, render), key="overview")
+        return active_projects
 
 class ProjectsMessages:
     def __init__(self, context):
@@ -159,8 +202,9 @@ class ProjectsMessages:
         return lambda m: self.ctx.state.project_message_id_store(project.id, m.message_id)
     
     def _delete_message(self, project_id):
-        msg_id = self.ctx.state.project_message_id_remove(id)
-        delete_bot_message(msg_id)
+        msg_id = self.ctx.state.archive_project(project_id)
+        if msg_id:
+            delete_bot_message(msg_id, self.ctx.state.message_delete_result)
 
     def _update_existing(self, projects):
         for id in projects.keys():
@@ -176,7 +220,7 @@ class ProjectsMessages:
         logging.info(f"Got {len(ids_new)} new and {len(ids_removed)} to delete")
         new_projects = sorted([active_projects[k] for k in active_projects if k in ids_new], key=lambda p: p.created)
         for p in new_projects:
-            send_with_bot(str(p), callback=self._store_message_id_cb(p))
+            send_with_bot(str(p), callback=self._store_message_id_cb(p), key=f"project:{p.id}")
 
         # TODO: can't delete old project so have to retrieve the current state from the backend and
         #       update its message
@@ -195,24 +239,39 @@ class HandleRatesMessage:
 
     def _format_message(self, pillar_list):
         pillar_list.sort(key=lambda p: p.rate, reverse=True)
-        strings = [f" <code>{p.active_rate:.2f}|{p.rate:.2f}</code> - {p.name}"
-                   for p in pillar_list if p.rate > 0]
-        header = "<b>Pillar participation rate (>0)</b>\n" + \
+        voted = [p for p in pillar_list if p.rate > 0]
+        header = "<b>Pillar participation rate (&gt;0)</b>\n" + \
                  "for voting on active projects and phases\n" + \
                  "Ongoing | All time\n\n"
-        never_voted = len(pillar_list) - len(strings)
+        never_voted = len(pillar_list) - len(voted)
         footer = f"{never_voted}/{len(pillar_list)} never voted"
-        return header + "\n".join(strings) + "\n\n" + footer
+        return join_fitting(header, voted, "\n\n" + footer,
+                            render=lambda p: rate_template.render(active_rate=p.active_rate, rate=p.rate, name=p.name))
     
-    def run(self, pillar_rates):
-        logging.info(f"New participation rates received for {len(pillar_rates)} pillars")
-        message_text = self._format_message(pillar_rates)
+    def _update_message(self, pillar_list):
+        message_text = self._format_message(pillar_list)
         existing_message_id = self.ctx.state.message_id_rates()
         if 0 != existing_message_id:
             edit_bot_message(existing_message_id, message_text)
         else:
             send_with_bot(message_text, 
-                          callback=lambda m: self.ctx.state.set_message_id_rates(m.message_id))
+                          callback=lambda m: self.ctx.state.set_message_id_rates(m.message_id),
+                          key="rates")
+
+    def run(self, pillar_rates):
+        logging.info(f"New participation rates received for {len(pillar_rates)} pillars")
+        self.ctx.state.pillar_rates.checkpoint(pillar_rates)
+        self._update_message(pillar_rates)
+
+class HandlePillarVote(HandleRatesMessage):
+    def __init__(self, context):
+        HandleRatesMessage.__init__(self, context)
+
+    def run(self, vote):
+        rates = self.ctx.state.pillar_rates
+        rates.vote(vote.name, vote.id)
+        if rates.checkpointed:
+            self._update_message(rates.pillar_list())
 
 class HandleProjectRefresh:
     def __init__(self, context):
@@ -231,10 +290,11 @@ class HandleProjectRefresh:
         edit_bot_message(message_id, str(project))
         if 1 < n:
             # Todo: does not work for older messages. Instead, replace the message text with a short notice?
-            delete_bot_message(message_id)
+            delete_bot_message(message_id, self.ctx.state.message_delete_result)
             status = "paid" if n == 2 else "closed" if n == 3 else "completed"
-            send_with_bot(f"<b>{project.name}</b>\nThe project has been {status}")
-            self.ctx.state.project_message_id_remove(project.id)
+            notify(self.ctx, "project:status-update", project, f"The project has been {status}",
+                   key=f"project:status:{project.id}:{n}")
+            self.ctx.state.archive_project(project.id, n)
 
         return True
 
@@ -274,9 +334,11 @@ class HandleNewProject(HandleProjectRefresh):
 
     def run(self, project):
         logging.info(f"RUN for HandleNewProject of {project}")
+        self.ctx.state.pillar_rates.open_item(project.id)
         HandleProjectRefresh._refresh_overview_message(self, project.data)
         send_with_bot(str(project), 
-                callback=lambda m: self._store_new_message_id(project.data, m.message_id))
+                callback=lambda m: self._store_new_message_id(project.data, m.message_id),
+                key=f"project:{project.id}")
     
 class HandleProjectUpdate(HandleProjectRefresh):
     def _init__(self, context):
@@ -290,12 +352,17 @@ class HandleProjectStatusUpdate(HandleProjectUpdate):
         HandleProjectUpdate.__init__(self, context)
 
     def run(self, update):
+        if 0 == update.old:
+            self.ctx.state.pillar_rates.close_item(update.id)
         project = HandleProjectUpdate.run(self, update)
         if project:
-            send_with_bot(f"<b>{project.name}</b>\nThe project has been {status_update_string(update.new)}")
+            notify(self.ctx, "project:status-update", project,
+                   f"The project has been {status_update_string(update.new)}",
+                   key=f"project:status-update:{update.id}:{update.new}")
 
 def format_phase(phase):
-    return f"<b>{phase.name}</b>\n{phase.description}\n{funds(phase)}\n\n{phase.url}"
+    return render_fitting(phase_template, "description", name=phase.name, description=phase.description,
+                          funds=funds(phase), url=phase.url)
 
 #@dataclass
 #class SyntheticProjectUpdate:
@@ -306,22 +373,27 @@ class HandleNewPhase(HandleProjectUpdate):
         HandleProjectUpdate.__init__(self, context)
 
     def run(self, update):
+        self.ctx.state.pillar_rates.open_item(update.data.id)
         # Updates overview message and the project's message
         project = self.ctx.config.requester.import_projects_by_ids([update.data.pid])[update.data.pid]
         HandleProjectUpdate.run(self, project)
         #project = HandleProjectUpdate.run(self, SyntheticProjectUpdate(update.data.pid))
-        send_with_bot(f"<b>{project.name}</b>\nNew phase is open for voting:\n\n{format_phase(update.data)}")
+        notify(self.ctx, "phase:new", project, f"New phase is open for voting:\n\n{format_phase(update.data)}",
+               key=f"phase:new:{update.data.id}")
 
 class HandlePhaseReset(HandleProjectUpdate):
     def __init__(self, context):
         HandleProjectUpdate.__init__(self, context)
 
     def run(self, update):
+        self.ctx.state.pillar_rates.close_item(update.old)
+        self.ctx.state.pillar_rates.open_item(update.data.id)
         # Updates overview message and the project's message
         project = self.ctx.config.requester.import_projects_by_ids([update.data.pid])[update.data.pid]
         HandleProjectUpdate.run(self, project)
         #project = HandleProjectUpdate.run(self, SyntheticProjectUpdate(update.data.pid))
-        send_with_bot(f"<b>{project.name}</b>\nCurrent phase was reset:\n\n{format_phase(update.data)}")
+        notify(self.ctx, "phase:update", project, f"Current phase was reset:\n\n{format_phase(update.data)}",
+               key=f"phase:update:{update.old}:{update.data.id}")
 
 class HandlePhaseUpdate(HandleProjectUpdate):
     def __init__(self, context):
@@ -337,9 +409,13 @@ class HandlePhaseStatusUpdate(HandlePhaseUpdate):
         HandlePhaseUpdate.__init__(self, context)
 
     def run(self, update):
+        if 0 == update.old:
+            self.ctx.state.pillar_rates.close_item(update.id)
         project = HandlePhaseUpdate.run(self, update)
         if project:
-            send_with_bot(f"<b>{project.name}</b>\nCurrent phase was {status_update_string(update.new)}")
+            notify(self.ctx, "phase:status-update", project,
+                   f"Current phase was {status_update_string(update.new)}",
+                   key=f"phase:status-update:{update.id}:{update.new}")
             
 class HandleManualUpdate:
     def __init__(self, context):
@@ -350,29 +426,52 @@ class HandleManualUpdate:
         logging.info(f"Sending manual update {text}")
         send_with_bot(text)
 
-# delegating updates received via zmq to corresponding handlers
+class HandleProfileControl:
+    def __init__(self, context):
+        self.context = context
 
-def handle_update(update, zmq, config, state):
+    def run(self, control):
+        if link:
+            link.profile(control)
+        if control.action == "start":
+            profiling.start(control.duration, control.interval)
+        elif control.action == "stop":
+            profiling.stop()
+        else:
+            logging.error(f"Unknown profile action {control.action}")
 
-    # any key associated with a Nop value is not handled
-    handler_map = {'project:new': [ProjectNew, HandleNewProject],
-                   'project:votes-update': [ProjectVotesUpdate, HandleProjectUpdate],
-                   'project:status-update': [ProjectStatusUpdate, HandleProjectStatusUpdate],
-                   'phase:new': [PhaseNew, HandleNewPhase],
-                   'phase:update': [PhaseUpdate, HandlePhaseReset],
-                   'phase:votes-update': [PhaseVotesUpdate, HandlePhaseUpdate],
-                   'phase:status-update': [PhaseStatusUpdate, HandlePhaseStatusUpdate],
-                   'pillar-stats': [PillarVotingStatus, HandleRatesMessage],
-                   'send': [ManualSend, HandleManualUpdate]}
+# delegating updates received via zmq to corresponding handlers
 
+# any key associated with a Nop value is not handled
+handler_map = {'project:new': [ProjectNew, HandleNewProject],
+               'project:votes-update': [ProjectVotesUpdate, HandleProjectUpdate],
+               'project:status-update': [ProjectStatusUpdate, HandleProjectStatusUpdate],
+               'phase:new': [PhaseNew, HandleNewPhase],
+               'phase:update': [PhaseUpdate, HandlePhaseReset],
+               'phase:votes-update': [PhaseVotesUpdate, HandlePhaseUpdate],
+               'phase:status-update': [PhaseStatusUpdate, HandlePhaseStatusUpdate],
+               'pillar-stats': [PillarVotingStatus, HandleRatesMessage],
+               'pillar:vote': [PillarVote, HandlePillarVote],
+               'send': [ManualSend, HandleManualUpdate],
+               'profile': [ProfileControl, HandleProfileControl]}
+
+def decode_update(update):
+    "Returns the handler key and the json of an update received via zmq"
+    if len(update) == 1: # json style message
+        js = json.loads(update[0])
+        handler_key = js['type']
+        del js['type']
+    else: # multipart message
+        handler_key = update[0].decode('utf-8')
+        js = json.loads(update[1])
+    return handler_key, js
+
+def typed_update(ctor, js):
+    return [ctor(**entry) for entry in js] if type(js) is list else ctor(**js)
+
+def handle_update(update, zmq, config, state):
     try:
-        if len(update) == 1: # json style message
-            js = json.loads(update[0])
-            handler_key = js['type']
-            del js['type']
-        else: # multipart message
-            handler_key = update[0].decode('utf-8')
-            js = json.loads(update[1])
+        handler_key, js = decode_update(update)
         h = handler_map[handler_key]
     except KeyError as ke:
         logging.error(f"No handler defined for {update}")
@@ -381,16 +480,17 @@ def handle_update(update, zmq, config, state):
     ctor = h[0]
     handler = h[1](HandlerContext(zmq, config, state))
     try:
-        typed_update = [ctor(**entry) for entry in js] if type(js) is list else ctor(**js)
+        typed = typed_update(ctor, js)
     except Exception as e:
         logging.error(f"Failed to get typed update: {str(e)}")
         return
 
     logging.info(f"Running {handler_key}-handler")
-    handler.run(typed_update)
+    handler.run(typed)
 
 def init_env():
     signal.signal(signal.SIGINT, handler)
+    signal.signal(signal.SIGTERM, handler)
     init_paths()
     config = TelegramConfig()
     setup_logging(config)
@@ -398,14 +498,22 @@ def init_env():
     logging.info("Found configuration in %s", config.filename)
     return config
 
-def init_bot(config):
-    logging.info("Starting bot for chat %d", config.chat())
-    build_bot(config.token(), config.chat())
+def load_state():
     state = TelegramState()
     logging.info("Telegram state loaded from %s, with %d projects", 
                  state.filename, len(state.message_ids_projects().keys()))
     return state
 
+def known_message_ids(state):
+    return [state.message_id_overview(), state.message_id_rates(), *state.message_ids_projects().values()]
+
+def init_bot(config):
+    logging.info("Starting bot for chat %d", config.chat())
+    build_bot(config.token(), config.chat(), config.http_settings())
+    state = load_state()
+    observe_message_ids(known_message_ids(state))
+    return state
+
 def project_is_active(p):
     return 1 == p.status
 
@@ -420,17 +528,67 @@ def do_after_bot_start(context, delay):
     active_projects = OverviewMessage(context).run()
     #ProjectsMessages(ctx).run(active_projects, update_existing=True)
 
+def run_delivery(ops_address, acks_address):
+    "Runs the bot in the delivery process, sending what the ingest process renders"
+    # the ingest process stops it, after sending what's left
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    config = TelegramConfig()
+    setup_logging(config, telegram_delivery_log_file())
+    logging.info("Starting delivery bot for chat %d", config.chat())
+    build_bot(config.token(), config.chat(), config.http_settings())
+    delivery = Delivery(zmq.Context(), ops_address, acks_address)
+    delivery.start()
+    run_bot(stop_signals=False)
+    delivery.stop()
+
 def main():
+    global link
     config = init_env()
-    state = init_bot(config)
+    delivery_endpoints = config.delivery_endpoints()
+    if delivery_endpoints:
+        # the bot, its scheduler and the api calls get their own process; started before
+        # any zmq context exists in this one
+        delivery = multiprocessing.get_context("spawn").Process(target=run_delivery, args=delivery_endpoints)
+        delivery.start()
+        state = load_state()
+    else:
+        state = init_bot(config)
     context = zmq.Context()
+    if delivery_endpoints:
+        link = DeliveryLink(context, *delivery_endpoints)
+        link.observe(known_message_ids(state))
+    if config.standin_fixtures():
+        start_embedded(context, config)
     
-    config.requester = Req(context, config.request_port())
+    config.requester = Req(context, config.request_endpoints(), config.request_strategy())
+    config.digest = Digest(config.digest_settings(), send_with_bot) if config.digest_settings() else None
 
-    with Subscriber(context, config.subscriber_port(), lambda s: handle_update(s, context, config, state)):
+    onmessage = lambda s: handle_update(s, context, config, state)
+    if config.recording_file():
+        onmessage = Recorder(config.recording_file()).tap(onmessage)
+
+    with Subscriber(context, config.subscriber_endpoints(), onmessage):
         global stop
         ctx = HandlerContext(context, config, state)
         # schedule update of the overview message after the bot started
         threading.Thread(target=do_after_bot_start, args=(ctx, 5))
-        run_bot()
+        if delivery_endpoints:
+            while not stop and delivery.is_alive():
+                time.sleep(1)
+            if delivery.is_alive():
+                # operations arrive in order, so the delivery process drains the last digest
+                # before it stops
+                if config.digest:
+                    config.digest.close()
+                link.stop_delivery()
+                delivery.join(stop_drain_s + 30)
+                if delivery.is_alive():
+                    logging.error("Delivery process didn't stop, terminating it")
+                    delivery.terminate()
+            link.stop()
+        else:
+            if config.digest:
+                stop_hooks.append(config.digest.close)
+            run_bot()
         stop = True
@@ -0,0 +1,120 @@
+# coding: utf-8
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# local
+from .conf import logdir
+
+# Sampling profiler for the handlers and the scheduled bot jobs, switched on and off through the
+# 'profile' control message. While it's off there is no sampler thread and no hook installed.
+
+max_duration_s = 600
+# each sample holds the GIL while it walks all threads' stacks
+min_interval_s = 0.005
+top_n = 20
+
+# only stacks passing through one of these are sampled, which leaves out idle waiting
+entry_points = {"handle_update", "initiate_send", "initiate_edit", "initiate_delete_batch", "schedule_job"}
+
+def frame_name(code):
+    return f"{os.path.basename(code.co_filename)}:{code.co_firstlineno}({code.co_name})"
+
+class Sampler(threading.Thread):
+    def __init__(self, duration, interval):
+        threading.Thread.__init__(self, daemon=True)
+        self.duration = duration
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.samples = 0
+        self.ticks = 0
+        self.elapsed = 0.0
+        self.cumulative = Counter()
+        self.own = Counter()
+        self.stacks = Counter()
+
+    def _sample(self):
+        self.ticks += 1
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == self.ident:
+                continue
+            stack = []
+            while frame:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            if not any(code.co_name in entry_points for code in stack):
+                continue
+            names = [frame_name(code) for code in reversed(stack)]
+            self.samples += 1
+            self.own[names[-1]] += 1
+            self.cumulative.update(set(names))
+            self.stacks[";".join(names)] += 1
+
+    def run(self):
+        start = time.monotonic()
+        deadline = start + self.duration
+        while not self.stopped.is_set() and time.monotonic() < deadline:
+            self._sample()
+            self.stopped.wait(self.interval)
+            self.elapsed = time.monotonic() - start
+        if not self.stopped.is_set():
+            logging.info(f"Profiling window of {self.duration}s ended")
+            finish(self)
+
+    def summary(self):
+        # the sampler thread competes for the GIL, so a sample stands for the measured time between two
+        t = self.elapsed / self.ticks if self.ticks else 0
+        lines = [f"{self.samples} samples in {self.elapsed:.1f}s",
+                 "cumulative   own  function"]
+        for name, n in self.cumulative.most_common(top_n):
+            lines.append(f"{n * t:9.2f}s {self.own[name] * t:6.2f}s {name}")
+        return "\n".join(lines)
+
+    def write(self):
+        "Writes the summary and the sampled stacks, in flamegraph's folded format, to the log directory."
+        # both processes write profiles when split
+        base = os.path.join(logdir(), time.strftime("profile-%Y%m%d-%H%M%S") + f"-{os.getpid()}")
+        with open(base + ".txt", "w") as f:
+            f.write(self.summary() + "\n")
+        with open(base + ".folded", "w") as f:
+            f.writelines(f"{stack} {n}\n" for stack, n in self.stacks.items())
+        return base
+
+sampler = None
+sampler_lock = threading.Lock()
+
+def start(duration=60, interval=0.01):
+    global sampler
+    with sampler_lock:
+        if sampler:
+            logging.warning("Profiling is already running")
+            return False
+        duration = min(max_duration_s, duration)
+        interval = max(min_interval_s, interval)
+        logging.info(f"Profiling for {duration}s, sampling every {interval}s")
+        sampler = Sampler(duration, interval)
+        sampler.start()
+        return True
+
+def finish(s):
+    global sampler
+    with sampler_lock:
+        if sampler is not s:
+            return None
+        sampler = None
+    summary = s.summary()
+    logging.info(f"Profile written to {s.write()}.txt\n{summary}")
+    return summary
+
+def stop():
+    "Stops profiling. Returns the summary of the top functions by cumulative time."
+    s = sampler
+    if not s:
+        logging.warning("Profiling is not running")
+        return None
+    s.stopped.set()
+    s.join()
+    return finish(s)
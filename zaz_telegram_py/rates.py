@@ -0,0 +1,118 @@
+# coding: utf-8
+import logging
+from array import array
+from collections import OrderedDict
+
+# local
+from .types import PillarVotingStatus
+
+# ids of closed items remembered to ignore votes arriving after the close
+closed_keep = 1024
+
+class PillarRates:
+    """Participation rates of pillars, kept up to date from single votes.
+
+    A rate is the share of all projects and phases a pillar voted on, the active rate the
+    share of those currently open for voting. The counters are arrays over the pillars; each
+    open project or phase holds the indices of the pillars that voted on it. The full list
+    from the backend is a checkpoint that replaces the counters, correcting any drift, e.g.
+    from votes on items the bot hasn't seen opening. It can only be counted on if the backend
+    sends the number of items and open items along with the rates."""
+
+    def __init__(self):
+        self.names = []
+        self.index = {}
+        self.voted = array('I')
+        self.voted_active = array('I')
+        self.items = 0
+        self.active = {} # id of an item open for voting -> set of pillar indices that voted on it
+        self.untracked = 0 # open items known only from a checkpoint
+        self.closed = OrderedDict() # ids of recently closed items
+        self.checkpointed = False
+        self.counts_missing_logged = False
+
+    def __len__(self):
+        return len(self.names)
+
+    def _pillar(self, name):
+        if name not in self.index:
+            self.index[name] = len(self.names)
+            self.names.append(name)
+            self.voted.append(0)
+            self.voted_active.append(0)
+        return self.index[name]
+
+    def open_items(self):
+        return len(self.active) + self.untracked
+
+    def checkpoint(self, pillar_list):
+        counts = {(p.items, p.open_items) for p in pillar_list}
+        if len(counts) != 1 or None in next(iter(counts)):
+            if not self.counts_missing_logged:
+                logging.warning("Pillar rates without item counts, not updating them from votes")
+                self.counts_missing_logged = True
+            self.checkpointed = False
+            return
+        items, active = counts.pop()
+        if items != self.items or active != self.open_items():
+            logging.info(f"Pillar rates checkpoint with {items} items, {active} open; "
+                         f"had {self.items}, {self.open_items()}")
+        self.items = items
+        for p in pillar_list:
+            i = self._pillar(p.name)
+            self.voted[i] = round(p.rate * items)
+            self.voted_active[i] = round(p.active_rate * active)
+        # the voters of the items open before the checkpoint are unknown
+        self.active = {}
+        self.untracked = active
+        self.checkpointed = True
+
+    def open_item(self, item_id):
+        "A project or phase was opened for voting"
+        if item_id not in self.active:
+            self.items += 1
+            self.active[item_id] = set()
+            self.closed.pop(item_id, None)
+
+    def close_item(self, item_id):
+        "Voting on a project or phase has ended"
+        if item_id in self.closed:
+            return
+        self.closed[item_id] = True
+        if len(self.closed) > closed_keep:
+            self.closed.popitem(last=False)
+        voters = self.active.pop(item_id, None)
+        if voters is None:
+            # opened before the checkpoint; its voters are corrected with the next one
+            self.untracked = max(0, self.untracked - 1)
+            return
+        for i in voters:
+            self.voted_active[i] -= 1
+
+    def vote(self, name, item_id):
+        if item_id in self.closed:
+            logging.debug(f"Ignoring vote of {name} on closed item {item_id}")
+            return
+        i = self._pillar(name)
+        if item_id not in self.active:
+            logging.debug(f"Vote of {name} on untracked item {item_id}")
+            self.active[item_id] = set()
+            if self.untracked:
+                # opened before the checkpoint, already counted
+                self.untracked -= 1
+            else:
+                # its opening was missed
+                self.items += 1
+        voters = self.active[item_id]
+        if i not in voters:
+            voters.add(i)
+            self.voted[i] += 1
+            self.voted_active[i] += 1
+
+    def pillar_list(self):
+        items = self.items or 1
+        active = self.open_items() or 1
+        # drift from untracked items can push a rate above 1 until the next checkpoint
+        return [PillarVotingStatus(name, min(1.0, self.voted[i] / items), min(1.0, self.voted_active[i] / active),
+                                   self.items, self.open_items())
+                for i, name in enumerate(self.names)]
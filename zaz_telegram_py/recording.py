@@ -0,0 +1,143 @@
+# coding: utf-8
+import argparse
+import bisect
+import logging
+import os
+import struct
+import sys
+import time
+import zmq
+
+# A recording is an append-only log of the multipart updates received by Sub. Each record is
+#   u32 record length | f64 receive time | u16 frame count | (u32 frame length | frame)*
+# The index file next to it holds one (f64 receive time, u64 offset) pair per record.
+
+magic = b"ZAZREC1\n"
+record_header = struct.Struct("<IdH")
+frame_header = struct.Struct("<I")
+index_entry = struct.Struct("<dQ")
+
+def index_file(filename):
+    return filename + ".idx"
+
+class Recorder:
+    def __init__(self, filename):
+        self.filename = filename
+        new = not os.path.exists(filename) or 0 == os.path.getsize(filename)
+        self.log = open(filename, "ab")
+        self.index = open(index_file(filename), "ab")
+        if new:
+            self.log.write(magic)
+        logging.info(f"Recording updates to {filename}")
+
+    def write(self, frames, received=None):
+        received = received if received else time.time()
+        offset = self.log.tell()
+        size = record_header.size + sum(frame_header.size + len(f) for f in frames)
+        self.log.write(record_header.pack(size, received, len(frames)))
+        for f in frames:
+            self.log.write(frame_header.pack(len(f)))
+            self.log.write(f)
+        self.log.flush()
+        self.index.write(index_entry.pack(received, offset))
+        self.index.flush()
+
+    def tap(self, onmessage):
+        "Wraps a Sub callback so every update is recorded before it's handled."
+        def recording_onmessage(frames):
+            try:
+                self.write(frames)
+            except OSError as e:
+                logging.error(f"Failed to record update: {str(e)}")
+            onmessage(frames)
+        return recording_onmessage
+
+    def close(self):
+        self.log.close()
+        self.index.close()
+
+def read_index(filename):
+    "Returns the receive times and offsets of all records."
+    times, offsets = [], []
+    with open(index_file(filename), "rb") as f:
+        for received, offset in index_entry.iter_unpack(f.read()):
+            times.append(received)
+            offsets.append(offset)
+    return times, offsets
+
+def read_records(filename, since=0):
+    "Yields (receive time, frames) of the records received at or after since."
+    offset = len(magic)
+    if since:
+        times, offsets = read_index(filename)
+        i = bisect.bisect_left(times, since)
+        if i == len(offsets):
+            return
+        offset = offsets[i]
+
+    with open(filename, "rb") as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError(f"{filename} is not a recording")
+        f.seek(offset)
+        while True:
+            header = f.read(record_header.size)
+            if len(header) < record_header.size:
+                return # end of file or a partially written last record
+            size, received, n = record_header.unpack(header)
+            body = f.read(size - record_header.size)
+            frames, pos = [], 0
+            for _ in range(n):
+                (length,) = frame_header.unpack_from(body, pos)
+                pos += frame_header.size
+                frames.append(body[pos:pos + length])
+                pos += length
+            if pos != len(body):
+                return
+            yield received, frames
+
+def replay(filename, onmessage, speed=1.0, since=0):
+    """Calls onmessage with the recorded updates. speed is a multiple of the recorded pace;
+    0 replays as fast as possible. Returns the number of updates."""
+    count = 0
+    first = None
+    start = time.monotonic()
+    for received, frames in read_records(filename, since):
+        if first is None:
+            first = received
+        if speed:
+            delay = (received - first) / speed - (time.monotonic() - start)
+            if 0 < delay:
+                time.sleep(delay)
+        onmessage(frames)
+        count += 1
+    return count
+
+def publish(filename, address, speed=1.0, since=0, warmup=1.0):
+    "Publishes the recorded updates on a PUB socket bound to address."
+    context = zmq.Context()
+    socket = context.socket(zmq.PUB)
+    socket.setsockopt(zmq.LINGER, 1000)
+    socket.bind(address)
+    # give subscribers time to connect, updates published before are dropped
+    time.sleep(warmup)
+    try:
+        return replay(filename, socket.send_multipart, speed, since)
+    finally:
+        socket.close()
+        context.term()
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays a recording of backend updates on a PUB socket")
+    parser.add_argument("recording")
+    parser.add_argument("--endpoint", default="tcp://127.0.0.1:5556", help="address to bind the PUB socket to")
+    parser.add_argument("--speed", type=float, default=1.0, help="multiple of the recorded pace, 0 for no delays")
+    parser.add_argument("--since", type=float, default=0, help="skip updates received before this unix time")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+    start = time.monotonic()
+    n = publish(args.recording, args.endpoint, args.speed, args.since)
+    logging.info(f"Published {n} updates in {time.monotonic() - start:.2f}s")
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,132 @@
+# coding: utf-8
+import argparse
+import json
+import logging
+import time
+import zmq
+from threading import Thread
+
+# local
+from .channels import endpoint, endpoints
+
+# A stand-in for the zenon-az backend, serving projects from fixtures. It answers the requests
+# Req makes and publishes updates the way the backend does, so the bot can run, and the
+# transports can be measured, without the real backend. With inproc:// endpoints it must
+# share the zmq context with the bot.
+#
+# A fixture file holds {"projects": {id: project}, "updates": [{"type": ..., ...}]}.
+
+def load_fixtures(filename):
+    with open(filename, "r") as f:
+        fixtures = json.load(f)
+    return fixtures.get("projects", {}), fixtures.get("updates", [])
+
+class StandIn(Thread):
+    def __init__(self, context, requests, subscriptions, projects):
+        Thread.__init__(self, daemon=True)
+        self.context = context
+        self.projects = projects
+        self.published = [] # (time, update)
+        self.version = 1 # increases with every published update
+        self.stopped = False
+        self.rep = context.socket(zmq.REP)
+        self.rep.setsockopt(zmq.LINGER, 0)
+        self.rep.setsockopt(zmq.RCVTIMEO, 200)
+        self.rep.bind(endpoint(requests))
+        self.pub = context.socket(zmq.PUB)
+        self.pub.setsockopt(zmq.LINGER, 0)
+        self.pub.bind(endpoint(subscriptions))
+        logging.info(f"Backend stand-in serving {len(projects)} projects on {endpoint(requests)}, "
+                     f"publishing on {endpoint(subscriptions)}")
+
+    def _active_projects(self):
+        return {k: p for k, p in self.projects.items() if p['status'] in [0, 1]}
+
+    def _projects(self, ids):
+        return {k: self.projects[k] for k in json.loads(ids) if k in self.projects}
+
+    def _current_phase(self, project_id):
+        project = self.projects.get(project_id.decode('utf-8'))
+        if not project or not project['phases']:
+            return {"error": "no phase"}
+        return project['phases'][-1]
+
+    def _updates_since(self, since):
+        since = float(since)
+        return [update for t, update in self.published if since < t]
+
+    def _versioned(self, data, version):
+        "Replies like a backend with versioned data; see Req._conditional_get"
+        if version is not None and int(version) == self.version:
+            return {"version": self.version, "not-modified": True}
+        return {"version": self.version, "data": data()}
+
+    def answer(self, frames):
+        version = lambda i: frames[i] if i < len(frames) else None
+        queries = {b"active-projects": lambda: self._versioned(self._active_projects, version(1)),
+                   b"projects": lambda: self._versioned(lambda: self._projects(frames[1]), version(2)),
+                   b"project-current-phase": lambda: self._current_phase(frames[1]),
+                   b"updates-since": lambda: self._updates_since(frames[1])}
+        try:
+            return queries[frames[0]]()
+        except (KeyError, IndexError, ValueError) as e:
+            logging.error(f"Stand-in can't answer {frames}: {str(e)}")
+            return {"error": f"invalid request {frames[0]}"}
+
+    def run(self):
+        while not self.stopped:
+            try:
+                frames = self.rep.recv_multipart()
+            except zmq.error.Again:
+                continue
+            self.rep.send_string(json.dumps(self.answer(frames)))
+        self.rep.close()
+
+    def publish(self, update):
+        "Publishes an update as a multipart message. Not thread safe, publish from one thread only."
+        update = dict(update)
+        update_type = update.pop('type')
+        if update_type == "project:new":
+            self.projects[update['id']] = update['data']
+        self.published.append((time.time(), dict(update, type=update_type)))
+        self.version += 1
+        self.pub.send_multipart([update_type.encode('utf-8'), json.dumps(update).encode('utf-8')])
+
+    def publish_all(self, updates, interval):
+        for update in updates:
+            time.sleep(interval)
+            logging.info(f"Publishing {update['type']}")
+            self.publish(update)
+
+    def stop(self):
+        self.stopped = True
+        self.join()
+        self.pub.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves fixtures in place of the zenon-az backend")
+    parser.add_argument("fixtures")
+    parser.add_argument("--requests", default="tcp://127.0.0.1:5555")
+    parser.add_argument("--subscriptions", default="tcp://127.0.0.1:5556")
+    parser.add_argument("--interval", type=float, default=5, help="seconds between the published updates")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+    projects, updates = load_fixtures(args.fixtures)
+    standin = StandIn(zmq.Context(), args.requests, args.subscriptions, projects)
+    standin.start()
+    try:
+        standin.publish_all(updates, args.interval)
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        standin.stop()
+
+def start_embedded(context, config, interval=5):
+    "Runs the stand-in in the bot's process, on the first configured endpoints."
+    projects, updates = load_fixtures(config.standin_fixtures())
+    standin = StandIn(context, endpoints(config.request_endpoints())[0],
+                      endpoints(config.subscriber_endpoints())[0], projects)
+    standin.start()
+    Thread(target=standin.publish_all, args=(updates, interval), daemon=True).start()
+    return standin
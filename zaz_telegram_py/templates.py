@@ -0,0 +1,110 @@
+# coding: utf-8
+import html
+import re
+from functools import lru_cache
+from string import Formatter
+
+# Telegram's limit for a message text, counted without the html tags
+max_message_length = 4096
+# room left in project and phase texts for the headers that are put around them
+fragment_length = max_message_length - 256
+
+_tag = re.compile(r"<[^>]*>")
+_entity = re.compile(r"&(?:#\d+|#x[0-9a-fA-F]+|\w+);")
+
+def escape(value):
+    "Makes a value from the backend safe to put into a message sent with ParseMode.HTML"
+    if value.__class__ is not str:
+        return str(value)
+    if "<" in value or ">" in value or "&" in value:
+        return html.escape(value, quote=False)
+    return value
+
+def visible_length(text):
+    "The length telegram counts for a message: without tags, entities as one character"
+    return len(_entity.sub("&", _tag.sub("", text)))
+
+class Template:
+    """A message template in str.format syntax, compiled once into a function.
+
+    Field values are escaped, except for fields with the conversion !h, which take html
+    that is already rendered, e.g. another template's output."""
+
+    def __init__(self, text):
+        self.text = text
+        fields = []
+        items = []
+        for literal, field, spec, conversion in Formatter().parse(text):
+            if literal:
+                items.append(repr(literal))
+            if field is None:
+                continue
+            if field not in fields:
+                fields.append(field)
+            expr = f"format({field}, {spec!r})" if spec else field
+            items.append(expr if conversion == "h" and spec else
+                         f"str({expr})" if conversion == "h" else f"escape({expr})")
+        # the fields become keyword-only arguments of the generated function
+        source = (f"lambda *, {', '.join(fields)}: " if fields else "lambda: ") + \
+                 "''.join((" + "".join(f"{i}, " for i in items) + "))"
+        self.render = eval(source, {"escape": escape, "format": format, "str": str})
+
+def render_fitting(template, field, limit=fragment_length, **values):
+    "Renders the template, shortening the free text in field so the result fits into limit."
+    text = template.render(**values)
+    if len(text) <= limit:
+        return text # tags and entities only add to the length
+    excess = visible_length(text) - limit
+    if excess <= 0:
+        return text
+    value = values[field]
+    values[field] = value[:max(0, len(value) - excess - 1)] + "…"
+    return template.render(**values)
+
+def join_fitting(header, lines, footer="", limit=max_message_length, render=None):
+    """Joins as many of the lines as fit into limit between header and footer, noting the rest.
+    With render, lines are items rendered by it, and only the ones that fit are rendered."""
+    budget = limit - visible_length(header) - visible_length(footer) - len(omitted_template.text) - 10
+    kept = []
+    used = 0
+    exact = False
+    for item in lines:
+        line = render(item) if render else item
+        n = len(line) + 1
+        if not exact and budget < used + n:
+            # the raw length is an upper bound, only near the limit the visible length is needed
+            used = visible_length("\n".join(kept)) + 1
+            exact = True
+        if exact:
+            n = visible_length(line) + 1
+            if budget < used + n:
+                break
+        used += n
+        kept.append(line)
+    body = "\n".join(kept)
+    if len(kept) < len(lines):
+        body += omitted_template.render(n=len(lines) - len(kept))
+    return header + body + footer
+
+# fragments repeated across messages are rendered once
+
+@lru_cache(maxsize=4096)
+def votes_line(yes, no, abstain):
+    return votes_template.render(yes=yes, no=no, abstain=abstain)
+
+@lru_cache(maxsize=4096)
+def funds_line(znn, qsr):
+    return funds_template.render(znn=znn, qsr=qsr)
+
+omitted_template = Template("\n<i>and {n} more</i>")
+votes_template = Template("<b>Yes</b> {yes}, <b>No</b> {no}, <b>Abstain</b> {abstain}\n")
+funds_template = Template("{znn} ZNN, {qsr} QSR")
+project_template = Template("<b>{name}</b>\nTotal: {funds!h}\n{status!h}\n\n{url}\n{description}\n\n")
+phase_voting_template = Template("\nPhase {n}: {name}\n{url}\n{funds!h}\n{votes!h}\n{quorum!h}")
+phase_status_template = Template("\nPhase {n} has been {status!h}")
+phase_template = Template("<b>{name}</b>\n{description}\n{funds!h}\n\n{url}")
+notification_template = Template("<b>{name}</b>\n{text!h}")
+summary_phase_template = Template("<b>{name}</b> <i>Phase {n}</i>\n{votes!h}")
+summary_accepted_template = Template("<b>{name}</b>\n{votes!h} (<i>Accepted</i>)")
+summary_template = Template("<b>{name}</b>\n{votes!h}")
+rate_template = Template(" <code>{active_rate:.2f}|{rate:.2f}</code> - {name}")
@@ -1,6 +1,11 @@
+import sys
 from dataclasses import dataclass
 from enum import Enum
 
+# local
+from .templates import (votes_line, funds_line, render_fitting, project_template,
+                        phase_voting_template, phase_status_template)
+
 class Status(Enum):
     PROJECT_NEEDS_VOTING = 0
     PROJECT_IS_ACCEPTED = 1
@@ -25,17 +30,20 @@ def get_status(project):
         # phase needs voting or is active or paid
         return Status(Status.PHASE_NEEDS_VOTING.value + phase.status)
 
-@dataclass
+# Projects are held in memory with long phase histories, so the records use slots, and the
+# strings repeated across them (project ids in phases, owner addresses) are interned.
+
+@dataclass(slots=True)
 class Votes:
     yes: int
     no: int
     abstain: int
 
     def __str__(self):
-        return f"<b>Yes</b> {self.yes}, <b>No</b> {self.no}, <b>Abstain</b> {self.abstain}\n"
+        return votes_line(self.yes, self.no, self.abstain)
 
 def funds(thing):
-    return f"{thing.znn} ZNN, {thing.qsr} QSR"
+    return funds_line(thing.znn, thing.qsr)
 
 def quorum_str():
     return f"<b>Quorum not reached yet</b>"
@@ -53,11 +61,12 @@ def status_string(project):
     n = len(project.phases)
     phase = project.phases[-1]
     if value is Status.PHASE_NEEDS_VOTING:
-        return f"\nPhase {n}: {phase.name}\n{phase.url}\n{funds(phase)}\n" + str(phase.votes) + f"\n{quorum_str()}"
+        return phase_voting_template.render(n=n, name=phase.name, url=phase.url, funds=funds(phase),
+                                            votes=str(phase.votes), quorum=quorum_str())
     status = "accepted" if value is Status.PHASE_IS_ACTIVE else f"paid {funds(phase)}" if value is Status.PHASE_IS_PAID else "closed"
-    return f"\nPhase {n} has been {status}"
+    return phase_status_template.render(n=n, status=status)
 
-@dataclass
+@dataclass(slots=True)
 class PhaseData:
     id: str
     pid: str
@@ -71,9 +80,10 @@ class PhaseData:
     votes: Votes
 
     def __post_init__(self):
+        self.pid = sys.intern(self.pid)
         self.votes = Votes(**self.votes)
 
-@dataclass
+@dataclass(slots=True)
 class Project:
     id: str
     created: int
@@ -88,16 +98,15 @@ class Project:
     votes: Votes
 
     def __post_init__(self):
+        self.id = sys.intern(self.id)
+        self.owner = sys.intern(self.owner)
         self.votes = Votes(**self.votes)
         self.phases = [PhaseData(**entry) for entry in self.phases]
 
     def __str__(self):
-        return (f"<b>{self.name}</b>\n" + 
-                f"Total: {funds(self)}\n" +
-                status_string(self) + "\n\n" +
-                f"{self.url}\n" +
-                f"{self.description}\n\n")
-                
+        return render_fitting(project_template, "description", name=self.name, funds=funds(self),
+                              status=status_string(self), url=self.url, description=self.description)
+
 
 @dataclass
 class ProjectNew:
@@ -163,7 +172,21 @@ class PillarVotingStatus:
     name: str
     rate: float
     active_rate: float
+    # projects and phases the rates are taken over; sent along by backends that count them
+    items: int = None
+    open_items: int = None
+
+@dataclass
+class PillarVote:
+    name: str
+    id: str
 
 @dataclass
 class ManualSend:
     text: str
+
+@dataclass
+class ProfileControl:
+    action: str # start or stop
+    duration: float = 60
+    interval: float = 0.01